@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+#  benchmark.py
+#
+#  End-to-end benchmark for generate_adblock_urls.py
+#
+# Licenced under Apache License Version 2.0
+
+'''
+Generates synthetic host sources in every format parser handles, serves them from a local HTTP server
+(HOSTS_URL points there) and times every stage of host generation separately:
+	download	: host list base and all sources, through download_database() and download_sources()
+	parse		: parse_source() for every source, like build with PARSE_WORKERS = 1 (without parsed cache)
+	dedupe		: merging per source stores into one, with source mask of every domain
+	write		: write_outputs() to TARGET_FILE
+	diff		: ONLY_ADD_NEW path, read_old_hosts() and find_new_hosts() against slightly changed hostset
+
+With --old-size, ONLY_ADD_NEW diff is also measured on its own, with old output of exactly that many hosts
+(and new hostset of the same size, DIFF_RATIO of it changed), so it doesn't depend on how many unique hosts
+sources happen to have:
+	read_old	: read_old_hosts() of old output
+	find_new	: find_new_hosts() against new hostset, as DomainStore like after parsing
+
+Everything runs in a temporary directory, so cache, logs and output of a real run aren't touched.
+Results are written as JSON, named after current git revision, so they can be compared between versions.
+
+Usage:
+	python benchmarks/benchmark.py [--sizes 100000,1000000,5000000] [--sources 8] [--old-size 1000000] [--output file.json]
+	python benchmarks/benchmark.py --sizes "" --old-size 1000000	(only ONLY_ADD_NEW diff)
+'''
+
+import argparse
+import collections
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every source is written in one of these formats, in turn
+FORMATS = ("hosts_zero", "hosts_local", "plain", "abp")
+
+# how many lines are comments or junk parser should drop
+JUNK_RATIO = 0.1
+
+# how many unique domains are there, compared to total line count. Rest are duplicates between sources.
+UNIQUE_RATIO = 0.6
+
+# share of hosts added and removed between old and new hostset in diff stage
+DIFF_RATIO = 0.05
+
+# makes domain from its number. Always the same for same number, so sources overlap.
+def make_domain(n):
+	return "ads%d.tracker%d.example%d.com" % (n, n % 977, n % 13)
+
+# makes one junk or comment line
+def make_junk(rnd, n):
+	return rnd.choice((
+		"# comment line %d" % n,
+		"! abp comment %d" % n,
+		"",
+		"http://example.com/path/%d.html" % n,
+		"banner%d.example.com/ad.gif" % n,
+		"||example%d.com/ads/*" % n,
+		"@@||allowed%d.example.com^" % n,
+		"##.ad-banner-%d" % n,
+		"0.0.0.0",
+		"google.com",
+		))
+
+# makes line for given domain in given source format
+def make_line(rnd, fmt, domain):
+	if fmt == "hosts_zero":
+		return rnd.choice(("0.0.0.0 %s", "0.0.0.0\t%s", "0.0.0.0 %s # tracker")) % domain
+	elif fmt == "hosts_local":
+		return rnd.choice(("127.0.0.1 %s", "127.0.0.1  %s", "127.0.0.1 %s:443")) % domain
+	elif fmt == "abp":
+		return rnd.choice(("||%s^", "||%s^$third-party", "||%s^$script,image")) % domain
+	return domain
+
+# writes synthetic sources and host list base to data_path. returns list of source file names.
+def generate_sources(data_path, total_lines, source_count, seed=1):
+	rnd = random.Random(seed)
+	unique = max(1, int(total_lines * UNIQUE_RATIO))
+	per_source = total_lines // source_count
+	names = []
+
+	for i in range(source_count):
+		fmt = FORMATS[i % len(FORMATS)]
+		name = "source_%d_%s.txt" % (i, fmt)
+		with open(os.path.join(data_path, name), "w") as source:
+			source.write("# synthetic %s list\n" % fmt)
+			for n in range(per_source):
+				if rnd.random() < JUNK_RATIO:
+					source.write("%s\n" % make_junk(rnd, n))
+				else:
+					source.write("%s\n" % make_line(rnd, fmt, make_domain(rnd.randrange(unique))))
+			source.close()
+		names.append(name)
+
+	return names
+
+# serves files from data_path on a random local port. returns (server, base url)
+def start_server(data_path):
+	class Handler(http.server.SimpleHTTPRequestHandler):
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, directory=data_path, **kwargs)
+
+		def log_message(self, *args):
+			pass
+
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return (server, "http://127.0.0.1:%d" % server.server_port)
+
+# current git revision of the generator, or "unknown"
+def git_revision():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_PATH, stderr=subprocess.DEVNULL).decode().strip()
+	except Exception:
+		return "unknown"
+
+# times one call. returns (seconds, result)
+def timed(fn, *args):
+	start = time.perf_counter()
+	result = fn(*args)
+	return (time.perf_counter() - start, result)
+
+# runs all stages for one size. g is imported generator module.
+def run_size(g, work_path, total_lines, source_count):
+	data_path = os.path.join(work_path, "data")
+	for path in (data_path, g.CACHE_PATH, "out"):
+		shutil.rmtree(path, ignore_errors=True)
+		os.makedirs(path)
+
+	print("* Generating %d lines in %d sources" % (total_lines, source_count))
+	names = generate_sources(data_path, total_lines, source_count)
+	(server, base_url) = start_server(data_path)
+
+	try:
+		with open(os.path.join(data_path, "adblock_list_domains.txt"), "w") as db:
+			db.write("# synthetic host list base\n")
+			for name in names:
+				db.write("%s/%s, %s\n" % (base_url, name, name))
+			db.close()
+
+		g.HOSTS_URL = "%s/adblock_list_domains.txt" % base_url
+		if os.path.isfile(g.HOSTS_FILENAME):
+			os.remove(g.HOSTS_FILENAME)
+
+		stages = collections.OrderedDict()
+
+		# download
+		def download():
+			g.download_database()
+			(state, content) = g.parse_host_database()
+			(dl_succ, changed) = g.download_sources(content)
+			return content
+		(stages["download"], content) = timed(download)
+
+		# parse
+		stats = {}
+		sources = [c_url[1].strip() for c_url in content]
+		def parse():
+			runs = []
+			for c_url in content:
+				description = c_url[1].strip()
+				counts = stats.setdefault(description, collections.Counter())
+				g.parse_source("%s/%s" % (g.CACHE_PATH, c_url[1]), description, runs, counts, c_url.format)
+			return runs
+		(stages["parse"], runs) = timed(parse)
+
+		# dedupe
+		(stages["dedupe"], hosts) = timed(g.DomainStore.merge, runs, sources)
+		runs = None
+
+		# write
+		(stages["write"], _) = timed(g.write_outputs, hosts, g.get_outputs(), content)
+
+		# diff: drop some hosts and add some new ones, just like sources do between runs
+		rnd = random.Random(2)
+		new_hosts = set(h for h in hosts if rnd.random() >= DIFF_RATIO)
+		new_hosts.update("new%d.example.net" % n for n in range(int(len(hosts) * DIFF_RATIO)))
+		def diff():
+			old = g.read_old_hosts()
+			return g.find_new_hosts(old, new_hosts)
+		(stages["diff"], missing) = timed(diff)
+
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	return {
+		"lines": total_lines,
+		"sources": source_count,
+		"parsed_lines": sum(c["lines"] for c in stats.values()),
+		"accepted_lines": sum(c["accepted"] for c in stats.values()),
+		"unique_hosts": len(hosts),
+		"store_kb": hosts.size() // 1024,
+		"new_hosts": len(missing),
+		"stages": dict((k, round(v, 4)) for (k, v) in stages.items()),
+	}
+
+# times ONLY_ADD_NEW diff alone, with old output of old_size hosts. g is imported generator module.
+def run_diff(g, work_path, old_size):
+	print("* Generating old output of %d hosts" % old_size)
+	rnd = random.Random(3)
+	old_hosts = [make_domain(n) for n in range(old_size)]
+
+	target = g.TARGET_FILE
+	g.TARGET_FILE = os.path.join(work_path, "out", "old_hostlist.txt")
+	os.makedirs(os.path.dirname(g.TARGET_FILE), exist_ok=True)
+
+	try:
+		with open(g.TARGET_FILE, "w") as old:
+			old.write(g.generate_banner())
+			for h in old_hosts:
+				old.write("%s %s\n" % (g.SINK_IP, h))
+			old.close()
+
+		# same size, but DIFF_RATIO of old hosts are gone and as many new ones came
+		new_hosts = [h for h in old_hosts if rnd.random() >= DIFF_RATIO]
+		new_hosts.extend("new%d.example.net" % n for n in range(old_size - len(new_hosts)))
+		new_hosts = g.DomainStore.from_domains(new_hosts)
+
+		stages = collections.OrderedDict()
+		(stages["read_old"], old) = timed(g.read_old_hosts)
+		(stages["find_new"], missing) = timed(g.find_new_hosts, old, new_hosts)
+
+	finally:
+		if os.path.isfile(g.TARGET_FILE):
+			os.remove(g.TARGET_FILE)
+		g.TARGET_FILE = target
+
+	return {
+		"old_hosts": len(old),
+		"new_hosts": len(new_hosts),
+		"added_hosts": len(missing),
+		"stages": dict((k, round(v, 4)) for (k, v) in stages.items()),
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="End-to-end benchmark for generate_adblock_urls.py")
+	parser.add_argument("--sizes", help="Comma separated total line counts (default: 100000,1000000,5000000)", default="100000,1000000,5000000")
+	parser.add_argument("--sources", help="Number of synthetic sources (default: 8)", type=int, default=8)
+	parser.add_argument("--old-size", help="Also times ONLY_ADD_NEW diff alone, with old output of this many hosts", type=int)
+	parser.add_argument("-o", "--output", help="JSON results file (default: benchmarks/results/<git revision>.json)")
+	args = parser.parse_args()
+
+	revision = git_revision()
+	output = args.output or os.path.join(REPO_PATH, "benchmarks", "results", "%s.json" % revision)
+	output = os.path.abspath(output)
+
+	# generator keeps cache and output relative to working directory, so keep it away from the repo
+	work_path = tempfile.mkdtemp(prefix="adblock_bench_")
+	cwd = os.getcwd()
+	os.chdir(work_path)
+
+	try:
+		sys.path.insert(0, REPO_PATH)
+		import generate_adblock_urls as g
+
+		g.HOSTS_FILENAME = os.path.join(work_path, "adblock_list_domains.txt")
+		g.HOSTS_ONLINE = True
+		g.TARGET_FILE = os.path.join(work_path, "out", "hostlist.txt")
+		g.CACHE_PATH = os.path.join(work_path, "cache")
+		g.CACHE_AGE = 0
+		# every size is parsed, not loaded from parsed cache
+		g.PARSED_CACHE = False
+		g.quiet = True
+
+		runs = []
+		for size in [int(s) for s in args.sizes.split(",") if len(s.strip()) > 0]:
+			run = run_size(g, work_path, size, args.sources)
+			print("-> %s" % json.dumps(run["stages"]))
+			runs.append(run)
+
+		diff = None
+		if args.old_size:
+			diff = run_diff(g, work_path, args.old_size)
+			print("-> %s" % json.dumps(diff["stages"]))
+
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(work_path, ignore_errors=True)
+
+	results = {
+		"revision": revision,
+		"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"runs": runs,
+		"diff": diff,
+	}
+
+	os.makedirs(os.path.dirname(output), exist_ok=True)
+	with open(output, "w") as out:
+		json.dump(results, out, indent=2)
+		out.close()
+
+	print("* Results written to %s" % output)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+#  parse_benchmark.py
+#
+#  Micro-benchmark of line parsing in generate_adblock_urls.py
+#
+# Licenced under Apache License Version 2.0
+
+'''
+Times line parsing alone, without reading files: synthetic lines (same generator as benchmark.py) are kept
+in memory as bytes, and every run goes over all of them:
+	classify	: classify_line() on every line, the general parser
+	<format>	: parse_lines() with format parser, on lines in that format (hosts, domains, abp)
+Every run is repeated, and the best time is kept.
+
+Usage:
+	python benchmarks/parse_benchmark.py [--lines 1000000] [--repeat 5] [--output file.json]
+'''
+
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+from benchmark import REPO_PATH, make_domain, make_junk, make_line, git_revision, JUNK_RATIO, UNIQUE_RATIO
+
+# generator formats, and format parser used for them
+PARSER_FORMATS = collections.OrderedDict((
+	("hosts_zero", "hosts"),
+	("hosts_local", "hosts"),
+	("plain", "domains"),
+	("abp", "abp"),
+))
+
+# makes count lines (bytes) in given generator format, with comments and junk among them
+def generate_lines(count, fmt, seed=1):
+	rnd = random.Random(seed)
+	unique = max(1, int(count * UNIQUE_RATIO))
+	lines = []
+	n = 0
+	while len(lines) < count:
+		if rnd.random() < JUNK_RATIO:
+			line = make_junk(rnd, n)
+		else:
+			line = make_line(rnd, fmt, make_domain(rnd.randrange(unique)))
+		# parsers never see empty lines, see iter_source_lines()
+		line = line.strip().encode("UTF-8")
+		if len(line) > 0:
+			lines.append(line)
+		n += 1
+	return lines
+
+# best time of repeat runs of fn(). returns (seconds, result of last run)
+def best_of(repeat, fn):
+	best = None
+	for r in range(repeat):
+		start = time.perf_counter()
+		result = fn()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return (best, result)
+
+def main():
+	parser = argparse.ArgumentParser(description="Micro-benchmark of line parsing in generate_adblock_urls.py")
+	parser.add_argument("--lines", help="Number of lines parsed in every run (default: 1000000)", type=int, default=1000000)
+	parser.add_argument("--repeat", help="How many times every run is repeated (default: 5)", type=int, default=5)
+	parser.add_argument("-o", "--output", help="JSON results file (default: only printed)")
+	args = parser.parse_args()
+
+	sys.path.insert(0, REPO_PATH)
+	import generate_adblock_urls as g
+	g.quiet = True
+
+	# same number of lines in every format, all of them together for general parser
+	per_format = args.lines // len(PARSER_FORMATS)
+	lines = collections.OrderedDict((fmt, generate_lines(per_format, fmt, i)) for (i, fmt) in enumerate(PARSER_FORMATS))
+	all_lines = [y for fmt_lines in lines.values() for y in fmt_lines]
+	print("* Parsing %d lines, best of %d runs" % (len(all_lines), args.repeat))
+
+	stages = collections.OrderedDict()
+
+	def classify():
+		return sum(1 for y in all_lines if g.classify_line(y)[0] is None)
+	(elapsed, accepted) = best_of(args.repeat, classify)
+	stages["classify"] = {"lines": len(all_lines), "accepted": accepted, "seconds": round(elapsed, 4), "lines_per_s": int(len(all_lines) / elapsed)}
+
+	for (fmt, parser_fmt) in PARSER_FORMATS.items():
+		def parse():
+			return sum(1 for y in g.parse_lines(iter(lines[fmt]), collections.Counter(), parser_fmt))
+		(elapsed, accepted) = best_of(args.repeat, parse)
+		stages[fmt] = {"lines": len(lines[fmt]), "accepted": accepted, "seconds": round(elapsed, 4), "lines_per_s": int(len(lines[fmt]) / elapsed)}
+
+	for (name, stage) in stages.items():
+		print("-> %-12s %8.3f s %12d lines/s" % (name, stage["seconds"], stage["lines_per_s"]))
+
+	if args.output:
+		results = {
+			"revision": git_revision(),
+			"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"stages": stages,
+		}
+		with open(args.output, "w") as out:
+			json.dump(results, out, indent=2)
+			out.close()
+		print("* Results written to %s" % os.path.abspath(args.output))
+
+if __name__ == '__main__':
+	main()
@@ -7,12 +7,31 @@
 # Licenced under Apache License Version 2.0
 
 import urllib.request
+import urllib.error
+import urllib.parse
+import http.client
+import socket
+import contextlib
 import os
 import sys
 import time
-import sh
 import argparse
 import shutil
+import concurrent.futures
+import threading
+import hashlib
+import json
+import re
+import collections
+import cProfile
+import tracemalloc
+import zlib
+import array
+import heapq
+import itertools
+import struct
+import gzip
+import mmap
 #################### CONFIGURATION BLOCK ####################
 '''
 Configuration values:
@@ -20,31 +39,89 @@ Configuration values:
 - HOSTS_FILENAME: file with host providers URLs and descriptions
 - HOSTS_ONLINE: use online source for host providers file
 - HOSTS_URL: self-explainatory, but ok: address of host provides file
-- TARGET_FILE: name of file where hosts are written
+- TARGET_FILE: name of file where hosts are written. TARGET_FILE.build next to it keeps fingerprint of configuration it was built with.
+- SINK_IP: address hosts in TARGET_FILE (and other hosts outputs) point to. 0.0.0.0 is faster on most systems.
+- EXTRA_OUTPUTS: other files written together with TARGET_FILE, as (format, path). Formats are hosts, domains, dnsmasq, unbound and rpz.
+- INDEX_FILE: sorted binary index of domains in TARGET_FILE, used by "query" command. None disables it.
+- COLLAPSE_SUBDOMAINS: in dnsmasq, unbound and rpz outputs, leave out subdomains of domains that are already blocked. Blocking there covers subdomains anyway.
 - DATABASE_AGE: how old can HOSTS_FILENAME file be before we redownload it. Useful only with HOSTS_ONLINE = True. Age is in days.
 - USE_CACHE: Self explainatory - cache downloaded host lists, and reuse them if they are under limited age. Age is in days
+- CACHE_AGE: how old cached host list can be before it's downloaded again (revalidated, if server allows). Age is in days
 - CACHE_PATH: where cache is stored
+- CACHE_COMPRESSION: store cached host sources gzipped. Saves disk space, but gzipped sources can't be memory mapped or split between parsing workers.
+- PARSED_CACHE: keep parsed domains of every source, so unchanged sources aren't parsed again. Needs USE_CACHE.
+- PARSED_CACHE_PATH: where parsed domains are stored
+- DOWNLOAD_WORKERS: how many host sources are downloaded at the same time
+- DOWNLOAD_TIMEOUT: how long a single host source can take to download, in total, before giving up on it. Time is in seconds.
+- DOWNLOAD_MAX_SIZE: biggest host source (or host list base) that is downloaded, in bytes, compressed or not. 0 disables the limit.
+- PARSE_WORKERS: how many processes parse host sources. 1 parses everything in this process, one source after another.
+- PARSE_CHUNK_SIZE: with PARSE_WORKERS > 1, bigger host sources are split in chunks of about this many bytes. Only uncompressed ones, see CACHE_COMPRESSION.
 - ONLY_ADD_NEW: this beauty tells this script to use data from old host file and add new entries, not to overwrite it.
 - USE_WHITELIST: allows us to whitelist some domains - for example, definitions from ABP lists contain a lot of wildstrings pointing to Google, Facebook and others, so after cleaning, we get whole domains blocked.
 - WHITELISTED_DOMAINS: contains whitelisted domains. Too lazy to move to external file
 - WHITELISTED_WILDCARD_DOMAINS: same as WHITELISTED_DOMAINS, but just for wildcards.
+- WHITELIST_FILENAME: external whitelist, one domain or wildcard per line. Used together with lists above, if it exists.
 - AUTO_PUSH: automatically pushes TARGET_FILE to preconfigured git repository.
+- PROGRESS_RATE: how many times per second progress bar can be redrawn.
+- PROGRESS_INTERVAL: when output isn't a terminal, progress is written as one line every this many seconds.
+- LOG_LEVEL: level of messages written to debug log. DEBUG logs every parsed line, and that's slow and huge.
+- LOG_PATH: where debug logs are written, a new file for every run. None disables debug log. Used only from command line.
+- STATS_FILE: if set, parsing statistics (lines per source and why they were dropped) are also written there as JSON.
+- PROVENANCE_FILE: if set, domains, unique domains and overlap of every source are printed and written there as JSON.
+- PROFILE_PARSE_FILE: if set, parse stage is profiled with cProfile and stats are dumped there (use pstats to read it).
+- DAEMON_INTERVAL: in daemon mode (--daemon), how often every host source is checked for changes, if it has no ttl in host list base. Time is in hours.
+- SOURCE_INTERVALS: in daemon mode, check intervals of specific host sources, by description, in hours. Busy lists can be checked hourly, slow ones weekly.
+- STATUS_PORT: in daemon mode, status is served as JSON on this port, on localhost only. None disables it.
 '''
 # All about host source and target file
 HOSTS_FILENAME = "sources/adblock_list_domains.txt"
 HOSTS_ONLINE = True
 HOSTS_URL = "https://raw.githubusercontent.com/ShadySquirrel/adblock_host_generator/master/sources/adblock_list_domains.txt"
 TARGET_FILE = "out/hostlist.txt"
+SINK_IP = "127.0.0.1"
+EXTRA_OUTPUTS = [
+	# ("dnsmasq", "out/dnsmasq.conf"),
+	# ("unbound", "out/unbound.conf"),
+	]
+COLLAPSE_SUBDOMAINS = False
+INDEX_FILE = "out/hostlist.idx"
 
 # database and cache
 DATABASE_AGE = 7
 USE_CACHE = True
 CACHE_AGE = 0.5
 CACHE_PATH = "cache"
+CACHE_COMPRESSION = True
+PARSED_CACHE = True
+PARSED_CACHE_PATH = "cache/parsed"
+
+# downloading
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_MAX_SIZE = 100*1024*1024
+
+# parsing
+PARSE_WORKERS = 1
+PARSE_CHUNK_SIZE = 4*1024*1024
 
 # misc
 ONLY_ADD_NEW = True
 AUTO_PUSH = True
+PROGRESS_RATE = 10
+PROGRESS_INTERVAL = 30
+LOG_LEVEL = "INFO"
+LOG_PATH = "logs"
+STATS_FILE = None
+PROVENANCE_FILE = None
+PROFILE_PARSE_FILE = None
+
+# daemon mode
+DAEMON_INTERVAL = 12
+SOURCE_INTERVALS = {
+	# "Some busy list": 1,
+	# "Some slow list": 168,
+	}
+STATUS_PORT = 8053
 
 # ignored chars. add yours, freely.
 ignore_tuple = ("#", "+", ".", ",", "/", "!", "?", "^", "$", "*", "|", "@", "&", "_", "[", "]", ":", ";", "=", " ", "\r", "\n", " ")
@@ -96,9 +173,15 @@ WHITELISTED_WILDCARD_DOMAINS = [
 	# XDA developers. I have no idea which list blocked it.
 	"*.xda-developers.com",
 	]
+
+# External whitelist file. Set to None to use only lists above.
+WHITELIST_FILENAME = "sources/whitelist.txt"
 #################### CONFIGURATION BLOCK END ####################
 
 #################### HERE BE LIONS ####################
+# names of configuration values above. configure() can set them, and parsing workers get their current values.
+CONFIG_NAMES = tuple(name for name in globals() if name.isupper())
+
 '''
 Scripts argumens. For now:
 	-cc, --clear-cache		: clears current cache folder
@@ -107,36 +190,94 @@ Scripts argumens. For now:
 	-dh, --download-hosts	: (re)downloads host definitions file. Removes cache automatically.
 	--no-push				: don't push changes to Git. Commit is still created.
 	--no-commit			: completely disables Git.
+	-w, --workers			: number of parallel downloads, overrides DOWNLOAD_WORKERS
+	-j, --jobs				: number of parsing processes, overrides PARSE_WORKERS
+	-q, --quiet				: don't show progress
+	-o, --output			: writes additional output, as FORMAT:PATH. Can be used more than once.
+	--sink-ip				: overrides SINK_IP
+	--collapse				: sets COLLAPSE_SUBDOMAINS
+	--log-level			: overrides LOG_LEVEL
+	--stats				: writes parsing statistics as JSON to given file, overrides STATS_FILE
+	--provenance		: writes domains, unique domains and overlap of every source as JSON to given file, overrides PROVENANCE_FILE
+	--profile			: measures every stage and writes report as JSON to given file
+	--profile-parse		: dumps cProfile stats of parse stage to given file, overrides PROFILE_PARSE_FILE
+	--daemon			: keeps running, and refreshes every host source on its own interval
+	--status-port		: overrides STATUS_PORT, 0 disables status server
+
+Commands:
+	query [--parents] [--index FILE] [DOMAIN ...]	: checks if domains are blocked, using INDEX_FILE. Without domains, reads them from stdin.
 '''
-parser = argparse.ArgumentParser()
-parser.add_argument("-cc", "--clear-cache", help="Clears current cache (removes everything from 'cache' folder", action="store_true")
-parser.add_argument("-r", "--remove", help="Removes generated hosts file before starting everything up", action="store_true")
-parser.add_argument("-fg", "--force-generate", help="Generates new hosts file even if no changes are visible.", action="store_true")
-parser.add_argument("-dh", "--download-hosts", help="(Re)downloads host definitions file. Removes cache automatically", action="store_true")
-parser.add_argument("--no-push", help="If AUTO_PUSH is set, don't auto push (still creates the commit)", action="store_true")
-parser.add_argument("--no-commit", help="Disables AUTO_PUSH - no commit is created, no git push is made", action="store_true")
+# builds command line parser
+def make_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-cc", "--clear-cache", help="Clears current cache (removes everything from 'cache' folder", action="store_true")
+	parser.add_argument("-r", "--remove", help="Removes generated hosts file before starting everything up", action="store_true")
+	parser.add_argument("-fg", "--force-generate", help="Generates new hosts file even if no changes are visible.", action="store_true")
+	parser.add_argument("-dh", "--download-hosts", help="(Re)downloads host definitions file. Removes cache automatically", action="store_true")
+	parser.add_argument("--no-push", help="If AUTO_PUSH is set, don't auto push (still creates the commit)", action="store_true")
+	parser.add_argument("--no-commit", help="Disables AUTO_PUSH - no commit is created, no git push is made", action="store_true")
+	parser.add_argument("-w", "--workers", help="Number of host sources downloaded in parallel (overrides DOWNLOAD_WORKERS)", type=int)
+	parser.add_argument("-q", "--quiet", help="Don't show progress", action="store_true")
+	parser.add_argument("-o", "--output", help="Writes additional output, as FORMAT:PATH (formats: hosts, domains, dnsmasq, unbound, rpz). Can be used more than once", action="append")
+	parser.add_argument("--sink-ip", help="Address hosts point to (overrides SINK_IP)")
+	parser.add_argument("--collapse", help="Leaves out subdomains of already blocked domains in dnsmasq, unbound and rpz outputs (sets COLLAPSE_SUBDOMAINS)", action="store_true")
+	parser.add_argument("--log-level", help="Level of messages written to debug log (overrides LOG_LEVEL). DEBUG logs every parsed line", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+	parser.add_argument("--stats", help="Writes parsing statistics as JSON to given file (overrides STATS_FILE)")
+	parser.add_argument("--provenance", help="Writes domains, unique domains and overlap of every source as JSON to given file (overrides PROVENANCE_FILE)")
+	parser.add_argument("--profile", help="Measures time and memory of every stage and writes report as JSON to given file")
+	parser.add_argument("--profile-parse", help="Dumps cProfile stats of parse stage to given file (overrides PROFILE_PARSE_FILE)")
+	parser.add_argument("--daemon", help="Keeps running and refreshes every host source on its own interval (DAEMON_INTERVAL, SOURCE_INTERVALS)", action="store_true")
+	parser.add_argument("--status-port", help="Port of daemon status server on localhost, 0 disables it (overrides STATUS_PORT)", type=int)
+	parser.add_argument("-j", "--jobs", help="Number of processes used for parsing host sources (overrides PARSE_WORKERS)", type=int)
+
+	commands = parser.add_subparsers(dest="command", metavar="command")
+	query_parser = commands.add_parser("query", help="Checks if domains are blocked, using INDEX_FILE. Without domains, reads them from stdin")
+	query_parser.add_argument("domains", help="Domains to check. Hosts lines (IP domain) are fine too", nargs="*", metavar="DOMAIN")
+	query_parser.add_argument("--parents", help="Domain is blocked also if any of its parents is (like in dnsmasq, unbound and rpz outputs)", action="store_true")
+	query_parser.add_argument("--index", help="Index file (default: INDEX_FILE)")
+
+	return parser
 
 '''
 Add debug logging. Really needed because I want to add as many domains as possible and it's almost impossible to read all of output during runtime
 '''
 import logging
-from logging.config import dictConfig
 
-if not os.path.exists("logs/"):
-	os.mkdir("logs")
+# everything is logged through this logger, never root one. Importing application decides where messages go;
+# without its own handlers, they go nowhere. Command line adds debug log in LOG_PATH, see setup_logging().
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# debug log handler, None until setup_logging() is called
+log_handler = None
+
+# starts writing debug log to a new file in LOG_PATH. done only once, and not at all if LOG_PATH is None.
+# Only command line calls it, build() leaves handlers to application using it.
+def setup_logging():
+	global log_handler
+	if log_handler is not None or LOG_PATH is None:
+		return
+
+	if not os.path.exists(LOG_PATH):
+		os.makedirs(LOG_PATH)
 
-logger = logging.getLogger()
-log_name = "logs/debug_%s.log" % time.ctime()
+	log_name = "%s/debug_%s.log" % (LOG_PATH, time.ctime())
 
-handler = logging.FileHandler(log_name)
-formatter = logging.Formatter(
-        '%(levelname)-2s %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+	log_handler = logging.FileHandler(log_name)
+	formatter = logging.Formatter(
+	        '%(levelname)-2s %(message)s')
+	log_handler.setFormatter(formatter)
+	logger.addHandler(log_handler)
+	set_log_level(LOG_LEVEL)
+	logger.info("Starting host generation at %s..", time.ctime())
 
-logger = logging.getLogger()
-logger.info("Starting host generation at %s..", time.ctime())
+# sets log level. per-line messages are logged only with DEBUG, they are really expensive.
+def set_log_level(level):
+	global log_lines
+	logger.setLevel(level)
+	log_lines = logger.isEnabledFor(logging.DEBUG)
+
+log_lines = False
 
 '''
 update_progress() : Displays or updates a console progress bar
@@ -148,8 +289,30 @@ Accepts a float between 0 and 1. Any int will be converted to a float.
 Function taken from https://stackoverflow.com/a/15860757, slightly modified to fit my needs
 modifications include support for description text (instead of "Percent" used in original)
 and little bit fixed formating (description is fixed-width, making things nicer)
+
+It's called for every line, so it's rate limited: bar is redrawn at most PROGRESS_RATE times per second.
+If output isn't a terminal (cron, log pipe), one line summary is written every PROGRESS_INTERVAL seconds instead.
+Halt and 100% are always shown. With quiet set (-q, --quiet), nothing is shown at all.
 '''
+# time of last progress redraw, and is stdout a terminal. latter is checked on first call.
+progress_last = 0.0
+progress_tty = None
+
 def update_progress(action, progress):
+    global progress_last, progress_tty
+    if quiet:
+        return
+
+    if progress_tty is None:
+        progress_tty = sys.stdout.isatty()
+
+    # skip this update if it's too soon and it's not the final one
+    now = time.monotonic()
+    final = not isinstance(progress, (int, float)) or progress < 0 or progress >= 1
+    if not final and now - progress_last < (1.0/PROGRESS_RATE if progress_tty else PROGRESS_INTERVAL):
+        return
+    progress_last = now
+
     barLength = 50 # Modify this to change the length of the progress bar
     status = ""
     if isinstance(progress, int):
@@ -163,6 +326,13 @@ def update_progress(action, progress):
     if progress >= 1:
         progress = 1
         status = "\r\n"
+
+    # no terminal, no bar
+    if not progress_tty:
+        sys.stdout.write("%s: %s%%\n" % (action, round(progress*100,2)))
+        sys.stdout.flush()
+        return
+
     block = int(round(barLength*progress))
     text = "\r{0:100} [{1}] {2}% {3}".format( action, "#"*block + "-"*(barLength-block), round(progress*100,2), status)
     sys.stdout.write(text)
@@ -174,7 +344,8 @@ def check_age(file, max_age):
 	if os.path.isfile(file):
 		created = os.path.getmtime(file)
 	else:
-		logging.error("can't check age for non-existing file %s", file)
+		# not downloaded yet, that's normal
+		logger.debug("can't check age for non-existing file %s", file)
 		created = 0
 
 	old_age = now - 60*60*24*max_age
@@ -188,162 +359,1234 @@ def check_age(file, max_age):
 
 	return state
 
-# parses sent string and returns value and state
-def parse_line(y):
-	# this defaults to true. runtime changes to false
-	write = True
-
-	logger.info("parsing line %s" , y)
+'''
+Line rules. ignore_tuple, ignore_host_tuple and ignore_extensions_touple are compiled into one regex,
+so every line is checked in a single pass instead of looping over every tuple.
+Line is rejected if regex finds anything in it, and name of matched group tells why.
+Most lines pass, so they're checked with quicker tests first: ignored starts and ends with bytes.startswith() and
+endswith(), and a regex with ignored symbols only. Full regex is searched only for lines failing those, to find out why.
+Lines are checked as bytes, straight from cached source, and only lines passing the rules are decoded.
+'''
+LINE_RULE_REASONS = {
+	"prefix": "an ignored symbol at the beginning",
+	"symbol": "an ignored symbol",
+	"extension": "a file extension at the end",
+	"suffix": "an ignored symbol at the end",
+}
+
+# compiled line rules. built on first use, see get_line_rules()
+line_rules = None
+
+# builds regex alternative matching any of given strings. Single chars are merged into one char class.
+def rule_alternatives(items):
+	chars = sorted(set(i for i in items if len(i) == 1))
+	words = sorted(set(i for i in items if len(i) > 1), key=len, reverse=True)
+
+	alternatives = [re.escape(w) for w in words]
+	if len(chars) > 0:
+		alternatives.append("[%s]" % "".join(re.escape(c) for c in chars))
+
+	# (?!) never matches - used if there's nothing to ignore
+	if len(alternatives) == 0:
+		return "(?!)"
+
+	return "(?:%s)" % "|".join(alternatives)
+
+# compiles ignore_tuple, ignore_host_tuple and ignore_extensions_touple into (rules, starts, ends, symbols):
+# single regex matching bytes, and quick tests - tuples of ignored starts and ends, and regex of ignored symbols.
+def compile_line_rules():
+	rules = re.compile(("(?P<prefix>\\A%s)|(?P<symbol>%s)|(?P<extension>%s\\Z)|(?P<suffix>%s\\Z)" % (
+		rule_alternatives(ignore_tuple),
+		rule_alternatives(ignore_host_tuple),
+		rule_alternatives(ignore_extensions_touple),
+		rule_alternatives(ignore_tuple))).encode("UTF-8"))
+	starts = tuple(i.encode("UTF-8") for i in ignore_tuple)
+	ends = tuple(i.encode("UTF-8") for i in ignore_extensions_touple + ignore_tuple)
+	symbols = re.compile(rule_alternatives(ignore_host_tuple).encode("UTF-8"))
+	return (rules, starts, ends, symbols)
+
+# returns compiled line rules, compiling them if needed
+def get_line_rules():
+	global line_rules
+	if line_rules is None:
+		line_rules = compile_line_rules()
+	return line_rules
+
+# rejection reasons, in the order they're shown in parsing statistics
+REJECT_REASONS = ("prefix", "symbol", "extension", "suffix", "exception", "partial", "whitelisted", "encoding", "error")
+
+# addresses hosts lines start with
+SINK_ADDRESSES = (b"0.0.0.0", b"127.0.0.1")
+
+# ABP rules start with these. @@ are exception rules.
+ABP_PREFIXES = (b"||", b"@@")
+
+# splits line (bytes) into words. bytes.split() knows only ASCII whitespace, but some lists separate words
+# with non-breaking space or other Unicode whitespace, so lines with other bytes are split after decoding.
+# If line isn't valid UTF-8, it's split on ASCII whitespace, and check_domain() tells what's wrong with it.
+def split_words(y):
+	if y.isascii():
+		return y.split()
+	try:
+		return [w.encode("UTF-8") for w in y.decode("UTF-8").split()]
+	except UnicodeDecodeError:
+		return y.split()
+
+# ABP rule which blocks whole domain: ||domain, optionally followed by ^ and |, and $options
+ABP_RULE = re.compile(rb"\|\|([^\^$/|*]+)\^?\|?(?:\$(.*))?\Z")
+
+# ABP options making rule apply only on some pages, or change requests instead of blocking them.
+# Blocking domain for such rule would block much more than list wants.
+ABP_PARTIAL_OPTIONS = frozenset((b"domain", b"denyallow", b"badfilter", b"removeparam", b"removeheader", b"redirect",
+	b"redirect-rule", b"csp", b"replace", b"header", b"permissions"))
+
+# takes domain out of ABP rule (bytes). returns (reason, value), where reason is None and value is domain
+# if rule blocks whole domain, "exception" for exception rules, or "partial" if rule blocks only some of its addresses.
+def read_abp_rule(y):
+	if y.startswith(b"@@"):
+		return ("exception", y)
+
+	rule = ABP_RULE.match(y)
+	if rule is None and not y.isascii():
+		# rule could still end with Unicode whitespace, like non-breaking space
+		try:
+			rule = ABP_RULE.match(y.decode("UTF-8").strip().encode("UTF-8"))
+		except UnicodeDecodeError:
+			pass
+	if rule is None:
+		return ("partial", y)
+
+	if rule.group(2) is not None:
+		for option in rule.group(2).split(b","):
+			if option.lstrip(b"~").split(b"=", 1)[0].strip().lower() in ABP_PARTIAL_OPTIONS:
+				return ("partial", y)
+
+	return (None, rule.group(1).strip())
+
+# checks domain (bytes) taken out of line: line rules, encoding and whitelist. returns (reason, value),
+# like classify_line(). Raises if nothing is left of the domain, callers count that as error.
+# Domains are normalized to lowercase (ASCII only, like DNS does), so EXAMPLE.COM and example.com are one domain.
+def check_domain(y):
+	y = y.lower()
+
+	# standard checks: ignored symbols at the start or end, ignored symbols anywhere in host and file extensions.
+	# we're blocking domains, not specific files. quick tests first, full rules tell why line is rejected.
+	(rules, starts, ends, symbols) = line_rules or get_line_rules()
+	if y.startswith(starts) or y.endswith(ends) or symbols.search(y):
+		rejected = rules.search(y)
+		if log_lines:
+			logger.debug("-> %s is not valid, it has %s '%s'", y, LINE_RULE_REASONS[rejected.lastgroup], rejected.group())
+		return (rejected.lastgroup, y)
+
+	# some lists have stray bytes in them. only this line is lost, not whole list.
+	try:
+		y = y.decode("UTF-8")
+	except UnicodeDecodeError:
+		if log_lines:
+			logger.debug("-> %s is not valid UTF-8", y)
+		return ("encoding", y)
+
+	# decoded line can still have whitespace bytes don't know about (like \x1c). second word is the domain then.
+	w = y.split()
+	y = w[1] if len(w) > 1 else w[0]
+
+	# check if host is in WHITELISTED_HOSTS:
+	if is_whitelisted(y):
+		if log_lines:
+			logger.debug("-> %s is whitelisted!", y)
+		return ("whitelisted", y)
+
+	return (None, y)
+
+# classifies sent line (bytes). returns (reason, value), where reason is None if line
+# is accepted and value is decoded domain, or one of REJECT_REASONS if it's not.
+# This is the general parser, format parsers use it for lines they don't expect.
+def classify_line(y):
+	if log_lines:
+		logger.debug("parsing line %s" , y)
 	try: # chances for errors are slim, but better safe than sorry.
 		# some lists have specific rules beggining with ||, filter them out.
-		if y.startswith("||"):
-			logger.debug("-> line requires spliting and filtering...")
-			# this should be done bit better?
-			y = y.strip("||")
-			z1 = y.split("^")
-			z = z1[0]
-			# now split on backslashes, and use only first part of it
-			w = z.split("/", 1)
-			y = w[0].strip()
+		if y.startswith(ABP_PREFIXES):
+			(reason, y) = read_abp_rule(y)
+			if reason is not None:
+				if log_lines:
+					logger.debug("-> %s is %s ABP rule", y, reason)
+				return (reason, y)
 
 		# if rule begins with 0.0.0.0 or 127.0.0.1, split it.
-		domains_touple = ("0.0.0.0", "127.0.0.1")
-		if y.startswith(domains_touple):
-			logger.debug("-> Line begins with address, check for ports and split it")
-			w = y.split()
+		if y.startswith(SINK_ADDRESSES):
+			w = split_words(y)
 			y = w[1]
 			# now, if domain has a port, remove it.
-			if ":" in y:
-				logger.debug("-> line contains a port, removing port")
-				w2 = y.split(":")
+			if b":" in y:
+				w2 = y.split(b":")
 				y = w2[0]
 
-		# specifics cleaned, now do standard checks. First, check if host entry is valid
-		if y.startswith(ignore_tuple):
-			write = False
-			logger.debug("-> it begins with an ignored symbol")
+		# specifics cleaned, now the standard checks
+		return check_domain(y)
 
-		# check if host is valid - if hosts contains any of symbols from list, ignore it.
-		for sym in ignore_host_tuple:
-			if sym in y:
-				write = False
-				logger.debug("-> it contains an ignored symbol '%s'" % sym)
+	except Exception as exc:
+		if log_lines:
+			logger.debug("-> parsing failed: %s", str(exc))
+		return ("error", y)
 
-		# check for file extensions. we're blocking domains, not specific files
-		if y.endswith(ignore_extensions_touple):
-			write = False
-			logger.debug("-> it ends with an extension")
+# parses sent string and returns value and state
+def parse_line(y):
+	(reason, y) = classify_line(y.encode("UTF-8"))
+	return (reason is None, y)
 
-		# check if host entry is ending in any of those ignored stuffs.
-		if y.endswith(ignore_tuple):
-			write = False
-			logger.debug("-> it ends with an ignored symbol")
+'''
+Domain store. Parsed domains are kept bare (without IP, that's added only when output is written),
+sorted and packed in one bytes blob, one domain per line, with array of offsets where each domain starts.
+That costs length of domain + 5 bytes per domain, instead of ~120 bytes for "127.0.0.1 domain" str in a set:
+2M unique domains (~32 chars each) take ~73 MB instead of ~240 MB.
+Every source is packed on its own, and sources are merged into one store in a single sorted pass.
+Merged store also knows where every domain came from: masks array has a bit for every source (names are
+in sources list) per domain. That's 1-8 bytes per domain, depending on number of sources, instead of
+keeping a copy of every source. Old output (ONLY_ADD_NEW) is read into a store too.
+Whole build of 2M unique domains in 8 sources peaks at ~210 MB RSS, ~275 MB with ONLY_ADD_NEW.
+'''
+# masks array type, by maximum number of sources it can hold
+MASK_TYPECODES = ((8, 'B'), (16, 'H'), (32, 'I'), (64, 'Q'))
+
+class DomainStore(object):
+	__slots__ = ("blob", "offsets", "masks", "sources")
+
+	def __init__(self, blob=b"", offsets=None, masks=None, sources=None):
+		self.blob = blob
+		self.offsets = offsets if offsets is not None else array.array('I', [0])
+		self.masks = masks
+		self.sources = sources
+
+	# packs domains (str or bytes) to a new store. duplicates are dropped.
+	@classmethod
+	def from_domains(cls, domains):
+		return cls.from_list([d.encode("UTF-8") if isinstance(d, str) else d for d in domains])
+
+	# packs list of domains (bytes) to a new store, dropping duplicates. List is sorted in place and emptied
+	# from the end while domains are packed, so every domain is freed as soon as it's in the blob, and
+	# the same domains are never kept twice: as objects and packed.
+	@classmethod
+	def from_list(cls, encoded):
+		encoded.sort(reverse=True)
+		blob = bytearray()
+		offsets = array.array('I', [0])
+		last = None
+		pop = encoded.pop
+		while encoded:
+			d = pop()
+			if d != last:
+				blob += d
+				blob += b"\n"
+				offsets.append(len(blob))
+				last = d
+		return cls(blob, offsets)
+
+	# makes a store from blob of sorted, unique, newline terminated domains
+	@classmethod
+	def from_blob(cls, blob):
+		offsets = array.array('I', [0])
+		pos = blob.find(b"\n")
+		while pos != -1:
+			offsets.append(pos + 1)
+			pos = blob.find(b"\n", pos + 1)
+		return cls(blob, offsets)
+
+	# merges stores into one, dropping duplicates. If sources is given (name of source for every store,
+	# store can be just a part of source), merged store keeps a mask of sources for every domain.
+	@classmethod
+	def merge(cls, stores, sources=None):
+		blob = bytearray()
+		offsets = array.array('I', [0])
+		last = None
+
+		names = list(dict.fromkeys(sources)) if sources is not None else []
+		typecode = next((t for (n, t) in MASK_TYPECODES if len(names) <= n), None)
+		if sources is None or typecode is None:
+			if sources is not None:
+				logger.warning("%d sources, provenance is kept only up to %d", len(names), MASK_TYPECODES[-1][0])
+
+			for d in heapq.merge(*[store.iter_bytes() for store in stores]):
+				if d != last:
+					blob += d
+					blob += b"\n"
+					offsets.append(len(blob))
+					last = d
+
+			return cls(blob, offsets)
+
+		# same loop, but every domain is tagged with bit of its source, and bits of duplicates are joined
+		masks = array.array(typecode)
+		tagged = [zip(store.iter_bytes(), itertools.repeat(1 << names.index(source))) for (store, source) in zip(stores, sources)]
+		for (d, bit) in heapq.merge(*tagged):
+			if d != last:
+				blob += d
+				blob += b"\n"
+				offsets.append(len(blob))
+				masks.append(bit)
+				last = d
+			else:
+				masks[-1] |= bit
+
+		return cls(blob, offsets, masks, names)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	# yields domains as bytes, in sorted order
+	def iter_bytes(self):
+		blob = self.blob
+		offsets = self.offsets
+		for i in range(len(offsets) - 1):
+			yield bytes(blob[offsets[i]:offsets[i+1] - 1])
+
+	def __iter__(self):
+		for d in self.iter_bytes():
+			yield d.decode("UTF-8")
+
+	# binary search. returns position of domain in store, or -1 if it isn't there.
+	def index(self, domain):
+		d = domain.encode("UTF-8")
+		blob = self.blob
+		offsets = self.offsets
+		lo = 0
+		hi = len(offsets) - 1
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if blob[offsets[mid]:offsets[mid+1] - 1] < d:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < len(offsets) - 1 and blob[offsets[lo]:offsets[lo+1] - 1] == d:
+			return lo
+		return -1
+
+	def __contains__(self, domain):
+		return self.index(domain) != -1
+
+	# returns names of sources domain at given position came from. empty if provenance isn't known.
+	def sources_at(self, i):
+		if self.masks is None:
+			return []
+		mask = self.masks[i]
+		return [name for (bit, name) in enumerate(self.sources) if mask >> bit & 1]
+
+	# memory used by packed data, in bytes
+	def size(self):
+		return len(self.blob) + self.offsets.itemsize * len(self.offsets)
+
+	# opens index written by write_index(). file is memory mapped, not read, so it's ready right away
+	# and only pages touched by lookups are loaded.
+	@classmethod
+	def from_index(cls, path):
+		with open(path, 'rb') as index:
+			data = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+
+		(magic, count, width) = struct.unpack_from(INDEX_HEADER, data)
+		if magic != INDEX_MAGIC:
+			raise ValueError("%s is not a domain index" % path)
+
+		offsets = memoryview(data)[INDEX_HEADER_SIZE:INDEX_HEADER_SIZE + 4*(count + 1)].cast('I')
+		if sys.byteorder != "little":
+			offsets = array.array('I', offsets)
+			offsets.byteswap()
+
+		# provenance follows the blob: masks, then JSON list of source names
+		masks = None
+		sources = None
+		if width > 0:
+			typecode = dict((array.array(t).itemsize, t) for (n, t) in MASK_TYPECODES)[width]
+			start = offsets[-1]
+			end = start + width*count
+			masks = memoryview(data)[start:end].cast(typecode)
+			if sys.byteorder != "little":
+				masks = array.array(typecode, masks)
+				masks.byteswap()
+			sources = json.loads(data[end:].decode("UTF-8"))
+
+		return cls(data, offsets, masks, sources)
 
-		# check if host is in WHITELISTED_HOSTS:
-		if check_if_whitelisted(y):
-			write = False
-			logger.debug("-> it's whitelisted!")
+'''
+Domain index. Final domains are written next to TARGET_FILE as a DomainStore, so "query" command can answer
+without parsing text output: header (magic, domain count, mask width), count+1 offsets as little endian uint32,
+then blob. Offsets are from the start of file, so memory mapped file is used as blob directly.
+If provenance is known (mask width isn't 0), blob is followed by source masks and JSON list of source names.
+'''
+INDEX_MAGIC = b"ADBIDX01"
+INDEX_HEADER = "<8sII"
+INDEX_HEADER_SIZE = struct.calcsize(INDEX_HEADER)
+
+# returns source masks of domains (DomainStore), taken from provenance store. domains not in it get 0.
+def match_masks(domains, provenance):
+	masks = array.array(provenance.masks.typecode)
+	other = zip(provenance.iter_bytes(), provenance.masks)
+	p = next(other, None)
+
+	for d in domains.iter_bytes():
+		while p is not None and p[0] < d:
+			p = next(other, None)
+		masks.append(p[1] if p is not None and p[0] == d else 0)
+
+	return masks
+
+# writes domains (DomainStore, or any iterable of str) to index file. written to temporary file first.
+# source masks are taken from domains, or from provenance store if domains don't have them.
+def write_index(domains, path, provenance=None):
+	if not isinstance(domains, DomainStore):
+		domains = DomainStore.from_domains(domains)
+
+	masks = domains.masks
+	sources = domains.sources
+	if masks is None and provenance is not None and provenance.masks is not None:
+		masks = match_masks(domains, provenance)
+		sources = provenance.sources
+
+	base = INDEX_HEADER_SIZE + domains.offsets.itemsize * len(domains.offsets)
+	offsets = array.array('I', (o + base for o in domains.offsets))
+	if sys.byteorder != "little":
+		offsets.byteswap()
+
+	with open("%s.tmp" % path, 'wb') as index:
+		index.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, len(domains), masks.itemsize if masks is not None else 0))
+		index.write(offsets.tobytes())
+		index.write(domains.blob)
+		if masks is not None:
+			masks = array.array(masks.typecode, masks)
+			if sys.byteorder != "little":
+				masks.byteswap()
+			index.write(masks.tobytes())
+			index.write(json.dumps(sources).encode("UTF-8"))
+		index.close()
+	os.replace("%s.tmp" % path, path)
+
+# looks domain up in store. returns (matched, position) for blocked domain that matched: domain itself or,
+# if parents is set, its closest parent in store. (None, -1) if domain isn't blocked.
+def lookup_domain(store, domain, parents=False):
+	domain = domain.rstrip(".").lower()
+	i = store.index(domain)
+	if i != -1:
+		return (domain, i)
+
+	if parents:
+		labels = domain.split(".")
+		for j in range(1, len(labels)):
+			parent = ".".join(labels[j:])
+			i = store.index(parent)
+			if i != -1:
+				return (parent, i)
+
+	return (None, -1)
+
+# "query" command. prints one line per domain: domain, blocked or not, matched domain and, if index knows it,
+# sources it came from ("-" if it's only in old hosts, see ONLY_ADD_NEW).
+# returns exit code: 0 if at least one domain is blocked, 1 if none is, 2 if index can't be read.
+def run_query(domains, parents=False, path=None):
+	path = path or INDEX_FILE
+	try:
+		store = DomainStore.from_index(path)
+	except Exception as err:
+		print("!! Can't read index %s: %s" % (path, repr(err)), file=sys.stderr)
+		return 2
+
+	# no domains given, take them from stdin. hosts lines work too, last word is domain.
+	lines = domains if len(domains) > 0 else sys.stdin
+	out = []
+	found = False
+	for line in lines:
+		w = line.split()
+		if len(w) == 0 or w[0].startswith("#"):
+			continue
+
+		(matched, i) = lookup_domain(store, w[-1], parents)
+		if matched is None:
+			out.append("%s\tnot blocked\n" % w[-1])
+		elif store.masks is None:
+			found = True
+			out.append("%s\tblocked\t%s\n" % (w[-1], matched))
+		else:
+			found = True
+			out.append("%s\tblocked\t%s\t%s\n" % (w[-1], matched, ", ".join(store.sources_at(i)) or "-"))
 
-		# all fine, return
-		if not write:
-			logger.debug("!!! %s is not valid line. Reasons above." % y)
+		if len(out) >= WRITE_BUFFER_LINES:
+			sys.stdout.write("".join(out))
+			del out[:]
 
-	except Exception as exc:
-		err = "ERROR: parsing failed: %s" % str(exc)
-		logger.error(err)
-		write = False
+	sys.stdout.write("".join(out))
+	return 0 if found else 1
+
+'''
+Parsing pipeline. Every stage is a generator, so cached source is never read in memory as a whole:
+	iter_source_lines() -> parse_lines() -> parse_source() adds to host set
+Plain cached sources are memory mapped, and lines are cut from the map as bytes one by one.
+Gzipped ones (CACHE_COMPRESSION) go through a streaming decompressor instead, which is slower.
+'''
+# how many lines are read between progress updates. even calling update_progress() costs more than reading a line.
+PROGRESS_LINES = 1000
+
+# yields stripped, non-empty lines (bytes) of cached source between start and end byte offsets.
+# Line ends are \n, \r\n or \r, like in text mode. If progress is given, it's called with
+# position in file every PROGRESS_LINES lines. gzipped source is read whole, through decompressor.
+def iter_source_lines(path, start=0, end=None, progress=None):
+	with open(path, 'rb') as raw:
+		if raw.peek(2)[:2] == GZIP_MAGIC:
+			source = gzip.GzipFile(fileobj=raw)
+			readline = source.readline
+			tell = raw.tell
+			end = None
+		else:
+			size = os.fstat(raw.fileno()).st_size
+			if end is None or end > size:
+				end = size
+			# empty file can't be mapped
+			if start >= end:
+				return
+			source = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+			source.seek(start)
+			readline = source.readline
+			tell = source.tell
+
+		with source:
+			n = 0
+			while end is None or tell() < end:
+				line = readline()
+				if len(line) == 0:
+					break
+
+				n += 1
+				if progress is not None and n % PROGRESS_LINES == 0:
+					progress(tell())
+
+				# strip it naked before parsing. line is useful to us only if it's longer than 0 chars
+				line = line.strip()
+				if b"\r" in line:
+					for y in line.splitlines():
+						y = y.strip()
+						if len(y) > 0:
+							yield y
+				elif len(line) > 0:
+					yield line
+
+# streams stripped, non-empty lines (bytes) from a cached host source, updating progress as it goes.
+def read_source_lines(path, description):
+	# progress is measured in bytes read from file, we don't know line count without reading whole file
+	s_size = max(os.path.getsize(path), 1)
+	action = "Parsing list: %s" % description
+
+	logger.debug("-> parsing contents of %s", path)
+	yield from iter_source_lines(path, progress=lambda pos: update_progress(action, min(pos/s_size, 0.99)))
+
+	update_progress(action, 1)
+
+'''
+Format parsers. Every source format has its own parser, doing only what lines of that format need:
+- hosts: line is split once, domain is the word after sink address
+- domains: line is the domain already, it's only checked
+- abp: domain is taken out of ||domain^$options rules. Rules blocking only some addresses of domain are dropped,
+  and @@||domain^ exception rules unblock domain and its subdomains in the same source.
+Lines a parser doesn't expect (like plain domain in hosts file) go through classify_line(), so result is the same
+whichever parser is used - format only decides what's tried first. Format is set in host list base, or sniffed
+from first SNIFF_LINES lines of cached source (see sniff_format()).
+Every parser takes stream of lines and Counter, yields domains from accepted lines, and counts lines in Counter:
+total, accepted and by rejection reason. If exceptions list is given, ABP exception rules are added to it,
+see drop_excepted().
+'''
+# how many lines of cached source are looked at to guess its format
+SNIFF_LINES = 500
+
+# lines starting with these are comments or list headers, in every format
+COMMENT_PREFIXES = (b"#", b"!", b"[")
+
+# general parser, for sources of unknown format
+def parse_any_lines(lines, stats, exceptions=None):
+	total = accepted = 0
+	try:
+		for y in lines:
+			total += 1
+			(reason, y) = classify_line(y)
+
+			if reason is None:
+				accepted += 1
+				yield y
+			else:
+				stats[reason] += 1
+				if reason == "exception" and exceptions is not None:
+					exceptions.append(y)
+	finally:
+		stats["lines"] += total
+		stats["accepted"] += accepted
+
+# parser for hosts files
+def parse_hosts_lines(lines, stats, exceptions=None):
+	total = accepted = 0
+	try:
+		for y in lines:
+			total += 1
+			if y.startswith(SINK_ADDRESSES):
+				try:
+					y = split_words(y)[1]
+					# now, if domain has a port, remove it.
+					if b":" in y:
+						y = y.split(b":", 1)[0]
+					(reason, y) = check_domain(y)
+				except Exception:
+					reason = "error"
+			else:
+				(reason, y) = classify_line(y)
+
+			if reason is None:
+				accepted += 1
+				yield y
+			else:
+				stats[reason] += 1
+				if reason == "exception" and exceptions is not None:
+					exceptions.append(y)
+	finally:
+		stats["lines"] += total
+		stats["accepted"] += accepted
+
+# parser for plain domain lists
+def parse_domain_lines(lines, stats, exceptions=None):
+	total = accepted = 0
+	special = ABP_PREFIXES + SINK_ADDRESSES
+	try:
+		for y in lines:
+			total += 1
+			if y.startswith(special):
+				(reason, y) = classify_line(y)
+			else:
+				try:
+					(reason, y) = check_domain(y)
+				except Exception:
+					reason = "error"
+
+			if reason is None:
+				accepted += 1
+				yield y
+			else:
+				stats[reason] += 1
+				if reason == "exception" and exceptions is not None:
+					exceptions.append(y)
+	finally:
+		stats["lines"] += total
+		stats["accepted"] += accepted
+
+# parser for ABP filter lists
+def parse_abp_lines(lines, stats, exceptions=None):
+	total = accepted = 0
+	try:
+		for y in lines:
+			total += 1
+			if y.startswith(ABP_PREFIXES):
+				(reason, domain) = read_abp_rule(y)
+				if reason is not None:
+					y = domain
+				elif domain.startswith(SINK_ADDRESSES):
+					# hosts line in ABP rule, general parser knows what to do with it
+					(reason, y) = classify_line(y)
+				else:
+					try:
+						(reason, y) = check_domain(domain)
+					except Exception:
+						reason = "error"
+			else:
+				(reason, y) = classify_line(y)
+
+			if reason is None:
+				accepted += 1
+				yield y
+			else:
+				stats[reason] += 1
+				if reason == "exception" and exceptions is not None:
+					exceptions.append(y)
+	finally:
+		stats["lines"] += total
+		stats["accepted"] += accepted
+
+# source formats (see host list base) and their parsers. auto is sniffed from cached source when it's parsed.
+SOURCE_FORMATS = {
+	"auto": parse_any_lines,
+	"hosts": parse_hosts_lines,
+	"domains": parse_domain_lines,
+	"abp": parse_abp_lines,
+}
+
+# guesses format of cached source from its first SNIFF_LINES lines: the one most of them are in.
+def sniff_format(path):
+	kinds = collections.Counter()
+	lines = iter_source_lines(path)
+	try:
+		for y in itertools.islice(lines, SNIFF_LINES):
+			if y.startswith(SINK_ADDRESSES):
+				kinds["hosts"] += 1
+			elif y.startswith(ABP_PREFIXES):
+				kinds["abp"] += 1
+			elif not y.startswith(COMMENT_PREFIXES):
+				kinds["domains"] += 1
+	finally:
+		lines.close()
+
+	if len(kinds) == 0:
+		return "auto"
+	return kinds.most_common(1)[0][0]
+
+# returns format cached source is parsed as: fmt, or sniffed one if fmt is auto
+def source_format(path, fmt="auto"):
+	if fmt != "auto":
+		return fmt
+	fmt = sniff_format(path)
+	logger.debug("-> %s looks like %s source", path, fmt)
+	return fmt
+
+# parses stream of lines and yields domains from accepted ones.
+# if stats Counter is given, lines are counted in it: total, accepted and by rejection reason.
+# fmt is format of source lines come from, one of SOURCE_FORMATS. auto uses general parser.
+# exception rules (lines, as bytes) are added to exceptions list, if it's given.
+def parse_lines(lines, stats=None, fmt="auto", exceptions=None):
+	if stats is None:
+		stats = collections.Counter()
+	return SOURCE_FORMATS[fmt](lines, stats, exceptions)
+
+# returns domains (bytes) unblocked by ABP exception rules: @@||domain^, with options which don't limit it
+# to some pages or addresses. Other exception rules can't unblock whole domain, so they're left out.
+def read_exceptions(rules):
+	domains = set()
+	for y in rules:
+		(reason, domain) = read_abp_rule(y[2:])
+		if reason is None:
+			domains.add(domain.lower())
+	return domains
+
+# drops domains (list of bytes) unblocked by exception rules of the same source: domain of the rule and its
+# subdomains, just like ||domain^ blocks them. List is changed in place. returns number of dropped domains.
+def drop_excepted(domains, rules):
+	unblocked = read_exceptions(rules)
+	if len(unblocked) == 0:
+		return 0
+
+	def excepted(d):
+		while True:
+			if d in unblocked:
+				return True
+			dot = d.find(b".")
+			if dot < 0:
+				return False
+			d = d[dot + 1:]
+
+	kept = [d for d in domains if not excepted(d)]
+	dropped = len(domains) - len(kept)
+	domains[:] = kept
+	return dropped
+
+# parses cached host source and adds its domains to runs list, packed in a DomainStore.
+# Raises on failure, caller reports it, domains parsed before failure are kept.
+# If source was already parsed with the same rules, domains are taken from parsed cache instead.
+# fmt is format of source, one of SOURCE_FORMATS. auto is sniffed from cached source.
+def parse_source(path, description, runs, stats=None, fmt="auto"):
+	if stats is None:
+		stats = collections.Counter()
+
+	key = None
+	if use_parsed_cache():
+		key = parsed_cache_key(path)
+		cached = load_parsed(key)
+		if cached is not None:
+			logger.info("%s is unchanged, using parsed cache", description)
+			(store, cached_stats) = cached
+			stats.update(cached_stats)
+			runs.append(store)
+			return key
+
+	# accepted domains are collected as bytes, duplicates are dropped when they're packed
+	domains = []
+	append = domains.append
+	exceptions = []
+	source_stats = collections.Counter()
+	fmt = source_format(path, fmt)
+	try:
+		for domain in parse_lines(read_source_lines(path, description), source_stats, fmt, exceptions):
+			append(domain.encode("UTF-8"))
+	finally:
+		stats.update(source_stats)
+		if drop_excepted(domains, exceptions) > 0:
+			logger.info("%s unblocks some of its domains with exception rules", description)
+		store = DomainStore.from_list(domains)
+		runs.append(store)
+
+	# got here, so parsing didn't fail - result is complete and can be cached
+	if key is not None:
+		save_parsed(key, store, source_stats)
+
+	return key
+
+'''
+Parsed sources cache. Accepted domains of every source are kept in PARSED_CACHE_PATH, zlib compressed,
+in a file named after source content hash and fingerprint of parser rules and whitelist.
+If neither source nor rules changed, domains are loaded from there and source isn't parsed again.
+Bump PARSER_VERSION when parsing code changes, so old results aren't used.
+'''
+PARSER_VERSION = 7
+
+# fingerprint of parser rules and whitelist. built on first use, see get_rules_fingerprint()
+rules_fingerprint = None
+
+# parsed cache is used only together with source cache
+def use_parsed_cache():
+	return USE_CACHE and PARSED_CACHE
+
+# returns fingerprint of everything that decides which lines are accepted
+def get_rules_fingerprint():
+	global rules_fingerprint
+	if rules_fingerprint is None:
+		(domains, wildcards) = read_whitelist_file(WHITELIST_FILENAME)
+		rules = [PARSER_VERSION, ignore_tuple, ignore_host_tuple, ignore_extensions_touple,
+			sorted(WHITELISTED_DOMAINS + domains), sorted(WHITELISTED_WILDCARD_DOMAINS + wildcards)]
+		rules_fingerprint = hashlib.sha256(json.dumps(rules).encode("UTF-8")).hexdigest()[:16]
+	return rules_fingerprint
+
+# returns sha256 of file content
+def hash_file(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1024*1024), b""):
+			h.update(block)
+	return h.hexdigest()
+
+# returns parsed cache key for cached host source
+def parsed_cache_key(path):
+	return "%s_%s" % (hash_file(path)[:32], get_rules_fingerprint())
+
+# loads parsed source. returns (DomainStore, stats) or None if it's not cached
+def load_parsed(key):
+	path = "%s/%s" % (PARSED_CACHE_PATH, key)
+	if not os.path.isfile(path):
+		return None
 
-	return (write, y)
+	try:
+		with open(path, 'rb') as parsed:
+			data = zlib.decompress(parsed.read())
+		# first line is statistics, everything else is packed DomainStore
+		(header, _, body) = data.partition(b"\n")
+		return (DomainStore.from_blob(body), collections.Counter(json.loads(header.decode("UTF-8"))))
+	except Exception as err:
+		logger.error("Failed loading parsed cache %s: %s" % (key, repr(err)))
+		return None
+
+# saves parsed source. written to temporary file first, so broken write never looks like a valid result.
+def save_parsed(key, store, stats):
+	if not os.path.isdir(PARSED_CACHE_PATH):
+		os.makedirs(PARSED_CACHE_PATH)
+
+	path = "%s/%s" % (PARSED_CACHE_PATH, key)
+	data = json.dumps(dict(stats)).encode("UTF-8") + b"\n" + bytes(store.blob)
+	with open("%s.tmp" % path, 'wb') as parsed:
+		parsed.write(zlib.compress(data))
+		parsed.close()
+	os.replace("%s.tmp" % path, path)
+
+# removes parsed results not used in this run - their sources or rules have changed
+def prune_parsed_cache(keys):
+	if not os.path.isdir(PARSED_CACHE_PATH):
+		return
+
+	for name in os.listdir(PARSED_CACHE_PATH):
+		if name not in keys:
+			logger.debug("removing stale parsed cache %s", name)
+			os.remove("%s/%s" % (PARSED_CACHE_PATH, name))
 
-# reads old hosts file and returns a list of hosts
+'''
+Parallel parsing. Used only if PARSE_WORKERS is bigger than 1.
+Every cached source is split into chunks of about PARSE_CHUNK_SIZE bytes (cut on line ends),
+and chunks are parsed in a pool of PARSE_WORKERS processes. Each worker returns only accepted domains, packed in a DomainStore.
+Gzipped sources (CACHE_COMPRESSION) can't be split, so each of them is parsed whole by one worker.
+'''
+# splits cached source into chunks, returns list of (start, end) byte offsets.
+# compressed source can't be split, so it's a single chunk.
+def split_source(path):
+	size = os.path.getsize(path)
+	bounds = [0]
+
+	if is_compressed(path):
+		return [(0, size)]
+
+	with open(path, 'rb') as source:
+		pos = PARSE_CHUNK_SIZE
+		while pos < size:
+			# move to the end of line chunk would be cut in
+			source.seek(pos)
+			source.readline()
+			pos = source.tell()
+			if pos >= size:
+				break
+			bounds.append(pos)
+			pos += PARSE_CHUNK_SIZE
+
+	bounds.append(size)
+	return list(zip(bounds, bounds[1:]))
+
+# parses one chunk of cached source and returns (store, stats, exceptions) - DomainStore with accepted domains,
+# Counter with parsing statistics and exception rules. Exception rules apply to the whole source, so they're
+# applied when all chunks are done. Runs in worker process. Compressed sources are always one chunk, see split_source().
+def parse_chunk(path, start, end, fmt="auto"):
+	stats = collections.Counter()
+	exceptions = []
+	store = DomainStore.from_list([d.encode("UTF-8") for d in parse_lines(iter_source_lines(path, start, end), stats, fmt, exceptions)])
+	return (store, stats, exceptions)
+
+# parses all cached sources in a process pool and adds their domains to runs list.
+# parsing statistics are added to stats dict, by source description. If run_sources list is given,
+# source description of every store added to runs is added to it. returns set of parsed cache keys used.
+def parse_sources_parallel(content, runs, stats, run_sources=None):
+	logger.info("Started parsing with %d workers", PARSE_WORKERS)
+	jobs = {}
+	keys = set()
+
+	# sources which aren't in parsed cache: description -> [key, chunk stores, stats, failed]
+	parsed = {}
+
+	# chunk stores and exception rules of every parsed source, by description
+	chunks = collections.OrderedDict()
+
+	# workers don't see values set by configure() unless they're forked, so they get them all when they start
+	with concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_WORKERS, initializer=configure, initargs=(config_snapshot(),)) as pool:
+		for c_url in content:
+			path = "%s/%s" % (CACHE_PATH, c_url[1])
+			description = c_url[1].strip()
+			try:
+				if use_parsed_cache():
+					key = parsed_cache_key(path)
+					keys.add(key)
+					cached = load_parsed(key)
+					if cached is not None:
+						logger.info("%s is unchanged, using parsed cache", description)
+						(store, cached_stats) = cached
+						stats.setdefault(description, collections.Counter()).update(cached_stats)
+						runs.append(store)
+						if run_sources is not None:
+							run_sources.append(description)
+						continue
+					parsed[description] = [key, [], collections.Counter(), False]
+
+				fmt = source_format(path, c_url.format)
+				for (start, end) in split_source(path):
+					jobs[pool.submit(parse_chunk, path, start, end, fmt)] = c_url
+			except Exception as err:
+				print("!! Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
+				logger.error(" Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
+				if description in parsed:
+					parsed[description][3] = True
+
+		# merge results as chunks are done
+		chunk_count = len(jobs)
+		c = 1.0
+		for job in concurrent.futures.as_completed(jobs):
+			c_url = jobs[job]
+			try:
+				(store, chunk_stats, exceptions) = job.result()
+				(stores, rules) = chunks.setdefault(c_url[1].strip(), ([], []))
+				stores.append(store)
+				rules.extend(exceptions)
+				stats.setdefault(c_url[1].strip(), collections.Counter()).update(chunk_stats)
+				if c_url[1].strip() in parsed:
+					parsed[c_url[1].strip()][2].update(chunk_stats)
+			except Exception as err:
+				print("!! Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
+				logger.error(" Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
+				if c_url[1].strip() in parsed:
+					parsed[c_url[1].strip()][3] = True
+
+			update_progress("Parsed %d of %d chunks" % (c, chunk_count), c/max(chunk_count, 1))
+			c+=1
+
+	# exception rules unblock domains in every chunk of their source
+	for (description, (stores, rules)) in chunks.items():
+		if len(rules) > 0:
+			domains = [d for store in stores for d in store.iter_bytes()]
+			if drop_excepted(domains, rules) > 0:
+				logger.info("%s unblocks some of its domains with exception rules", description)
+			stores = [DomainStore.from_list(domains)]
+		runs.extend(stores)
+		if run_sources is not None:
+			run_sources.extend([description] * len(stores))
+
+		# keep whole source together, so it can be cached
+		if description in parsed:
+			parsed[description][1] = stores
+
+	# cache only sources with all chunks parsed
+	for (key, stores, source_stats, failed) in parsed.values():
+		if not failed:
+			save_parsed(key, DomainStore.merge(stores), source_stats)
+
+	# remove tmp files
+	if not USE_CACHE:
+		for c_url in content:
+			path = "%s/%s" % (CACHE_PATH, c_url[1])
+			if os.path.isfile(path):
+				logger.debug("removing cached file %s...", path)
+				os.remove(path)
+
+	return keys
+
+# prints parsing statistics as a table, one row per source
+def print_parse_stats(stats):
+	columns = ("lines", "accepted") + REJECT_REASONS
+	row = "{0:40} " + " ".join("{%d:>11}" % (i + 1) for i in range(len(columns)))
+
+	print("* Parsing statistics:")
+	print(row.format("source", *columns))
+
+	total = collections.Counter()
+	for (description, counts) in stats.items():
+		print(row.format(description[:40], *[counts[c] for c in columns]))
+		total.update(counts)
+
+	print(row.format("total", *[total[c] for c in columns]))
+
+# writes parsing statistics to JSON file
+def write_parse_stats(stats, path):
+	columns = ("lines", "accepted") + REJECT_REASONS
+	with open(path, 'w') as stats_file:
+		json.dump(dict((d, dict((c, counts[c]) for c in columns)) for (d, counts) in stats.items()), stats_file, indent=2)
+		stats_file.close()
+
+# counts domains and unique domains (found only there) of every source, and overlap of every pair of sources.
+# domains are counted by their source mask, and there are only as many masks as there are source combinations.
+def provenance_report(store):
+	names = store.sources or []
+	domains = collections.Counter()
+	unique = collections.Counter()
+	overlap = collections.defaultdict(collections.Counter)
+
+	for (mask, count) in collections.Counter(store.masks or []).items():
+		found = [name for (bit, name) in enumerate(names) if mask >> bit & 1]
+		for (i, name) in enumerate(found):
+			domains[name] += count
+			for other in found[i+1:]:
+				overlap[name][other] += count
+				overlap[other][name] += count
+		if len(found) == 1:
+			unique[found[0]] += count
+
+	return {
+		"domains": len(store),
+		"sources": dict((name, {"domains": domains[name], "unique": unique[name], "overlap": dict(overlap[name])}) for name in names),
+	}
+
+# prints domains and unique domains of every source, and source it overlaps the most with
+def print_provenance(report):
+	row = "{0:40} {1:>11} {2:>11} {3:>9}  {4}"
+
+	print("* Provenance:")
+	print(row.format("source", "domains", "unique", "unique %", "overlaps most with"))
+	for (name, counts) in report["sources"].items():
+		most = max(counts["overlap"].items(), key=lambda o: o[1], default=None)
+		print(row.format(name[:40], counts["domains"], counts["unique"],
+			"%.1f" % (100.0 * counts["unique"] / max(counts["domains"], 1)),
+			"%s (%d)" % most if most is not None else "-"))
+
+# writes provenance report to JSON file
+def write_provenance(report, path):
+	with open(path, 'w') as provenance_file:
+		json.dump(report, provenance_file, indent=2)
+		provenance_file.close()
+
+# reads old hosts file and returns its domains (without IP), packed in a DomainStore. Lines are read as bytes
+# and only domains are kept until they're packed, old output is never held as a list of str.
 def read_old_hosts():
 	logger.info("Started reading old hosts...")
 	old_hosts = []
-	lines = []
-	with open(TARGET_FILE, "r") as target:
-		lines = target.readlines()
-		target.close()
 
-	for x in lines:
-		if not x.startswith("#"):
-			z = x.strip()
-			z1 = z.rstrip("\n")
-			z2 = z1.rstrip("\r")
+	with open(TARGET_FILE, "rb") as target:
+		for x in target:
+			if not x.startswith(b"#"):
+				w = x.split()
+
+				# check if host isn't in whitelist. we're dropping the IP part of host.
+				# older outputs weren't normalized, so domains are lowercased like parsed ones.
+				if len(w) > 0:
+					d = w[-1].lower()
+					if not is_whitelisted(d.decode("UTF-8")):
+						old_hosts.append(d)
+
+	return DomainStore.from_list(old_hosts)
+
+'''
+Whitelist index. Built once from WHITELISTED_DOMAINS, WHITELISTED_WILDCARD_DOMAINS and WHITELIST_FILENAME:
+- plain domains go to a set
+- "*.domain" wildcards go to a set of their endings, looked up once for every parent of domain
+- any other wildcard (like "ads?.domain") is compiled with fnmatch into one regex
+Index also keeps parents of whitelisted domains, so subdomain collapsing never blocks them through a parent.
+'''
+# whitelist index. built on first use, see get_whitelist_index()
+whitelist_index = None
+
+# reads whitelist file: one domain or wildcard per line, lines starting with # are comments.
+# returns (domains, wildcards) lists, both empty if file doesn't exist.
+def read_whitelist_file(path):
+	domains = []
+	wildcards = []
+
+	if path is None or not os.path.isfile(path):
+		return (domains, wildcards)
+
+	with open(path) as wf:
+		for line in wf:
+			line = line.strip()
+			if len(line) == 0 or line.startswith("#"):
+				continue
+			if any(c in line for c in "*?["):
+				wildcards.append(line)
+			else:
+				domains.append(line)
 
-			# check if host isn't in whitelist
-			whitelisted = check_if_whitelisted(z2)
+	return (domains, wildcards)
 
-			if not whitelisted:
-				old_hosts.append(z2)
+# domain (bytes) with labels reversed and joined with \0: ads.example.com -> com\0example\0ads.
+# \0 sorts before anything domain can contain, so sorted domains are followed by all of their subdomains.
+def reverse_labels(d):
+	return b"\x00".join(reversed(d.split(b".")))
 
-	return old_hosts
+# adds domain made of given labels, and all of its parents, to set of reversed domains
+def add_parents(parents, labels):
+	for i in range(len(labels)):
+		parents.add(reverse_labels(".".join(labels[i:]).encode("UTF-8")))
 
-# checks if given host is in whitelist
+# builds whitelist index
+def build_whitelist_index(domains, wildcards):
+	import fnmatch
+	suffixes = []
+	patterns = []
+	# domains that can't be blocked with their subdomains, because something under them is whitelisted.
+	# None if there's a wildcard without fixed ending, because then it could be anything.
+	parents = set()
+
+	for d in domains:
+		add_parents(parents, d.split(".")[1:])
+
+	for wc in wildcards:
+		labels = wc.split(".")
+		fixed = [i for i in range(len(labels)) if any(c in labels[i] for c in "*?[")]
+		if parents is not None and len(fixed) > 0 and fixed[-1] == len(labels) - 1:
+			parents = None
+		elif parents is not None:
+			add_parents(parents, labels[fixed[-1] + 1 if len(fixed) > 0 else 0:])
+
+		suffix = wc[2:]
+		# only "*.something" goes to suffixes, everything else is matched the old way
+		if wc.startswith("*.") and not any(c in suffix for c in "*?["):
+			suffixes.append(suffix)
+		else:
+			patterns.append(fnmatch.translate(wc))
+
+	return {
+		"domains": frozenset(domains),
+		"suffixes": frozenset(suffixes),
+		"patterns": re.compile("|".join(patterns)) if len(patterns) > 0 else None,
+		"parents": frozenset(parents) if parents is not None else None,
+	}
+
+# returns whitelist index, building it if needed
+def get_whitelist_index():
+	global whitelist_index
+	if whitelist_index is None:
+		(domains, wildcards) = read_whitelist_file(WHITELIST_FILENAME)
+		whitelist_index = build_whitelist_index(WHITELISTED_DOMAINS + domains, WHITELISTED_WILDCARD_DOMAINS + wildcards)
+		logger.info("Whitelist index built: %d domains, %d wildcards", len(whitelist_index["domains"]), len(WHITELISTED_WILDCARD_DOMAINS) + len(wildcards))
+	return whitelist_index
+
+# checks if given host (line with domain, second word is used if there are more) is in whitelist
 def check_if_whitelisted(host):
-	h = None
 	sp = host.split()
 	if len(sp) == 1:
-		h = sp[0]
-	else:
-		h = sp[1]
+		return is_whitelisted(sp[0])
+	return is_whitelisted(sp[1])
 
-	whitelisted = False
+# checks if given domain is in whitelist
+def is_whitelisted(h):
+	index = whitelist_index or get_whitelist_index()
 
 	# check regular list
-	if h in WHITELISTED_DOMAINS:
-		logger.debug("%s is whitelisted in WHITELISTED_DOMAINS", h)
-		whitelisted = True
+	if h in index["domains"]:
+		if log_lines:
+			logger.debug("%s is whitelisted in WHITELISTED_DOMAINS", h)
+		return True
 
-	# now check if wildcard is applied
-	import fnmatch
-	for wc in WHITELISTED_WILDCARD_DOMAINS:
-		wl = fnmatch.fnmatch(h, wc)
-		if wl:
+	# now check if wildcard is applied: "*.example.com" whitelists every domain with parent example.com.
+	# one set lookup per label, no matter how many wildcards there are
+	suffixes = index["suffixes"]
+	if suffixes:
+		dot = h.find(".")
+		while dot >= 0:
+			if h[dot + 1:] in suffixes:
+				if log_lines:
+					logger.debug("%s is whitelisted (partial match) in WHITELISTED_WILDCARD_DOMAINS", h)
+				return True
+			dot = h.find(".", dot + 1)
+
+	# and finally, wildcards suffixes can't handle
+	if index["patterns"] is not None and index["patterns"].match(h):
+		if log_lines:
 			logger.debug("%s is whitelisted (partial match) in WHITELISTED_WILDCARD_DOMAINS", h)
-		if not whitelisted and whitelisted != wl:
-			whitelisted = wl
+		return True
+
+	return False
+
+# compares two hostsets and returns (added, removed) sets. Both are packed into sorted DomainStores (if they
+# aren't already) and walked together once, so it's linear in size of both, no matter how big old hostset is.
+def diff_hosts(old, new):
+	if not isinstance(old, DomainStore):
+		old = DomainStore.from_domains(old)
+	if not isinstance(new, DomainStore):
+		new = DomainStore.from_domains(new)
+
+	added = set()
+	removed = set()
+
+	old_iter = old.iter_bytes()
+	new_iter = new.iter_bytes()
+	o = next(old_iter, None)
+	n = next(new_iter, None)
+
+	while o is not None or n is not None:
+		if n is None or (o is not None and o < n):
+			removed.add(o.decode("UTF-8"))
+			o = next(old_iter, None)
+		elif o is None or n < o:
+			added.add(n.decode("UTF-8"))
+			n = next(new_iter, None)
+		else:
+			o = next(old_iter, None)
+			n = next(new_iter, None)
 
-	# return now.
-	return whitelisted
+	return (added, removed)
 
 # finds new hosts between two hostsets
 def find_new_hosts(old, new):
-	logging.info("Starting search for new hosts...")
-	missing_hosts = []
-	# convert old and new to sets
-	hOld = set(old)
-	hNew = set(new)
+	logger.info("Starting search for new hosts...")
 
-	# now find uncommon entries.
-	tmp = list(hNew^hOld)
-
-	# and count em
-	eMissing = len(tmp)
+	(added, removed) = diff_hosts(old, new)
 
 	# and inform
-	msg = "* Total %d hosts not common for both new and old list" % eMissing
+	msg = "* Total %d hosts not common for both new and old list (%d new, %d no longer in sources)" % (len(added) + len(removed), len(added), len(removed))
 	print(msg)
-	logging.debug(msg)
+	logger.debug(msg)
 
-	# now check if uncommon entries are present in old hosts, if not, add to missing hosts
-	print("-> Searching for missing entries, be patient, this may take a while")
-	for h in tmp:
+	# entries missing from old hosts are new ones
+	missing_hosts = set()
+	for h in added:
 		if not h.startswith(ignore_tuple):
-			h = h.strip()
-			if h not in old:
-				logging.debug("-> %s is not found in old hosts, marking as new", h)
-				missing_hosts.append(h)
+			missing_hosts.add(h.strip())
 
-	# finished. return. Doing a set() to remove possible duplicates.
-	return list(set(missing_hosts))
+	return list(missing_hosts)
 
 def push_to_git():
 	logger.info("Starting git push")
-	# initialize git via sh module. Smart, eh?
+	# initialize git via sh module. Smart, eh? imported only here, it's not needed without AUTO_PUSH.
+	import sh
 	git = sh.git.bake(_cwd=os.getcwd())
 	msg = "* Initialized git in %s" % os.getcwd()
 	print(msg)
-	logging.debug(msg)
+	logger.debug(msg)
 
 
 	# generate commit msg
@@ -351,13 +1594,13 @@ def push_to_git():
 	commit_time = time.strftime("%H:%M:%S")
 	commit_msg = "HOSTS: %s update (at %s)" % (commit_date, commit_time)
 	print("* Generated commit message: %s" % commit_msg)
-	logging.debug("* Commit message: %s", commit_msg)
+	logger.debug("* Commit message: %s", commit_msg)
 
 	# get remote url
 	print("* Generating git url")
 	remote = git.remote().strip()
 	remote_url = git.remote("get-url", remote, "--push")
-	logging.debug("* git push url: %s", remote_url)
+	logger.debug("* git push url: %s", remote_url)
 
 	# we'll need this later.
 	url = remote_url
@@ -393,12 +1636,11 @@ def push_to_git():
 
 		print("* Done!")
 
-# generates banner placed on top of generated hosts file
-def generate_banner():
+# generates banner placed on top of generated hosts file. comment is comment mark of output format,
+# content is list of host sources from host list base.
+def generate_banner(comment="#", content=()):
 	import datetime
 
-	(state, content) = parse_host_database()
-
 	time_now = datetime.datetime.now()
 
 	banner_string = "###########################################################################\n"
@@ -410,6 +1652,10 @@ def generate_banner():
 
 	banner_string += "###########################################################################\n"
 
+	# not every format uses '#' for comments
+	if comment != "#":
+		banner_string = "".join("%s%s\n" % (comment, line) for line in banner_string.splitlines())
+
 	return banner_string
 
 # database downloader
@@ -438,7 +1684,6 @@ def download_database():
 				msg = "-> Host list base is older than %d days, redownloading" % DATABASE_AGE
 				print(msg)
 				logger.debug(msg)
-				os.remove(HOSTS_FILENAME)
 				to_download = True
 			else:
 				print("-> Host list base is still fresh enough")
@@ -446,13 +1691,8 @@ def download_database():
 		# to_download flag is true, well, download now. Only reason why I've put try-except here
 		if to_download:
 			print("* Started host base download.")
-			#hosts_file = urllib.URLopener()
-			#hosts_file.retrieve(HOSTS_URL, HOSTS_FILENAME)
-
-			h = urllib.request.urlopen(HOSTS_URL)
-			with open(HOSTS_FILENAME, 'w') as hf:
-				hf.write(h.read().decode("UTF-8"))
-				hf.close()
+			# old one is replaced only when new one is complete
+			stream_download(HOSTS_URL, HOSTS_FILENAME, max_size=DOWNLOAD_MAX_SIZE)
 
 		return True
 
@@ -461,7 +1701,477 @@ def download_database():
 		logger.error("Host database download failed (%s)" % str(err))
 		return False
 
-# parse host database
+# reads metadata sidecar (ETag, Last-Modified, content hash) of cached host source.
+# returns empty dict if there isn't one or it's broken.
+def read_cache_meta(path):
+	try:
+		with open("%s.meta" % path) as meta_file:
+			return json.load(meta_file)
+	except Exception:
+		return {}
+
+# writes metadata sidecar next to cached host source
+def write_cache_meta(path, meta):
+	with open("%s.meta" % path, 'w') as meta_file:
+		json.dump(meta, meta_file)
+		meta_file.close()
+
+'''
+Compression. Sources are requested with Accept-Encoding: gzip and deflate always, brotli and zstd
+if brotli and zstandard modules are installed. With CACHE_COMPRESSION, cached sources are stored gzipped,
+and parser reads them through a streaming decompressor. Uncompressed cached files are still read as they are.
+'''
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# returns Accept-Encoding header value, with everything we can decompress
+def accept_encoding():
+	encodings = ["gzip", "deflate"]
+	if brotli is not None:
+		encodings.append("br")
+	if zstandard is not None:
+		encodings.append("zstd")
+	return ", ".join(encodings)
+
+# returns decompressor of response body with given Content-Encoding: function taking next chunk of body
+# and returning decompressed bytes. It's called with b"" at the end, to get what's left.
+def body_decoder(encoding):
+	encoding = (encoding or "identity").strip().lower()
+
+	if encoding in ("identity", ""):
+		return lambda data: data
+	elif encoding in ("gzip", "x-gzip", "deflate"):
+		state = {}
+		def decode(data):
+			if "zlib" not in state:
+				# some servers send raw deflate instead of zlib stream, zlib header tells which one it is
+				if encoding != "deflate":
+					wbits = 16 + zlib.MAX_WBITS
+				elif len(data) >= 2 and data[0] & 0x0f == 8 and ((data[0] << 8) | data[1]) % 31 == 0:
+					wbits = zlib.MAX_WBITS
+				else:
+					wbits = -zlib.MAX_WBITS
+				state["zlib"] = zlib.decompressobj(wbits)
+			return state["zlib"].decompress(data) if len(data) > 0 else state["zlib"].flush()
+		return decode
+	elif encoding == "br" and brotli is not None:
+		decompressor = brotli.Decompressor()
+		return lambda data: decompressor.process(data) if len(data) > 0 else b""
+	elif encoding == "zstd" and zstandard is not None:
+		decompressor = zstandard.ZstdDecompressor().decompressobj()
+		return lambda data: decompressor.decompress(data) if len(data) > 0 else b""
+
+	raise ValueError("unsupported Content-Encoding '%s'" % encoding)
+
+# checks if cached file is gzipped
+def is_compressed(path):
+	with open(path, 'rb') as f:
+		return f.read(2) == GZIP_MAGIC
+
+'''
+Connection pool. Most host sources live on a few hosts (raw.githubusercontent.com, s3.amazonaws.com...),
+so downloads go over HTTP/1.1 keep-alive connections kept per (scheme, host, port), and next source from the
+same host reuses idle connection instead of doing TCP and TLS handshakes again. Resolved addresses are cached too.
+Connection goes back to pool only when its response was read to the end, anything else closes it.
+Pool and DNS cache live until close_connections() - end of build, or of every check in daemon mode.
+Proxies set in environment are used through urlopen(), without pool.
+'''
+# idle connections, by (scheme, host, port), and resolved addresses, by (host, port). both guarded by pool_lock.
+idle_connections = {}
+dns_cache = {}
+pool_lock = threading.Lock()
+
+# how many redirects are followed
+MAX_REDIRECTS = 5
+
+# returns addresses of host, resolving it only the first time
+def resolve_host(host, port):
+	with pool_lock:
+		addresses = dns_cache.get((host, port))
+
+	if addresses is None:
+		addresses = [info[4][:2] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+		with pool_lock:
+			dns_cache[(host, port)] = addresses
+
+	return addresses
+
+# socket.create_connection() using cached addresses. pooled connections are made with it.
+def create_connection(address, timeout=None, source_address=None):
+	error = None
+	for ip_address in resolve_host(*address):
+		try:
+			return socket.create_connection(ip_address, timeout, source_address)
+		except OSError as err:
+			error = err
+	raise error
+
+# returns (connection, reused): idle connection to host from pool, or a new one
+def get_connection(key):
+	with pool_lock:
+		idle = idle_connections.get(key)
+		if idle:
+			return (idle.pop(), True)
+
+	(scheme, host, port) = key
+	if scheme == "https":
+		conn = http.client.HTTPSConnection(host, port, timeout=DOWNLOAD_TIMEOUT)
+	else:
+		conn = http.client.HTTPConnection(host, port, timeout=DOWNLOAD_TIMEOUT)
+	conn._create_connection = create_connection
+	return (conn, False)
+
+# puts connection back to pool if its response was read to the end and server keeps it open, closes it otherwise.
+# response cut short by server is closed too, but its length tells there's something missing.
+def release_connection(key, conn, response):
+	if response.isclosed() and not response.will_close and not response.length:
+		with pool_lock:
+			idle_connections.setdefault(key, []).append(conn)
+	else:
+		conn.close()
+
+# closes idle connections and forgets resolved addresses
+def close_connections():
+	with pool_lock:
+		for conns in idle_connections.values():
+			for conn in conns:
+				conn.close()
+		idle_connections.clear()
+		dns_cache.clear()
+
+# sends GET request over pooled connection. returns (connection, response).
+# server could have closed idle connection meanwhile, so request failing on reused one is sent again on another.
+def send_request(key, path, headers):
+	while True:
+		(conn, reused) = get_connection(key)
+		try:
+			conn.request("GET", path, headers=headers)
+			return (conn, conn.getresponse())
+		except (http.client.RemoteDisconnected, ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+			conn.close()
+			if not reused:
+				raise
+
+# opens url over pooled connection, following redirects. used as context manager, yields http.client.HTTPResponse.
+# Like urlopen(), raises urllib.error.HTTPError for error statuses and 304 Not Modified.
+@contextlib.contextmanager
+def open_url(url, headers):
+	if urllib.request.getproxies():
+		with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT) as response:
+			yield response
+		return
+
+	for redirect in range(MAX_REDIRECTS + 1):
+		parts = urllib.parse.urlsplit(url)
+		if parts.scheme not in ("http", "https"):
+			raise ValueError("unsupported URL scheme '%s'" % parts.scheme)
+		key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+		path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+		(conn, response) = send_request(key, path, headers)
+
+		if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+			# redirect bodies are short, read them so connection can be used again
+			response.read()
+			release_connection(key, conn, response)
+			url = urllib.parse.urljoin(url, response.getheader("Location"))
+			continue
+
+		if response.status >= 400 or response.status == 304:
+			# 304 (most common answer when refreshing) has no body, and short error pages can be skipped too
+			if response.length is not None and response.length <= DOWNLOAD_CHUNK_SIZE:
+				response.read()
+				release_connection(key, conn, response)
+			else:
+				conn.close()
+			raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+		try:
+			yield response
+		finally:
+			release_connection(key, conn, response)
+		return
+
+	raise urllib.error.HTTPError(url, response.status, "too many redirects", response.headers, None)
+
+'''
+Downloads. Response body is streamed to path.part in DOWNLOAD_CHUNK_SIZE chunks, just as server sent it,
+then decompressed chunk by chunk to path.tmp (gzipped again with CACHE_COMPRESSION), and only complete
+file is renamed over the old one. Neither whole body nor decompressed content is ever in memory.
+Bodies bigger than max size (DOWNLOAD_MAX_SIZE, or max_size of source) are refused, compressed or not.
+Interrupted download stays in path.part, and next download asks only for the rest of it with Range,
+if server told us ETag or Last-Modified - If-Range makes sure we get the whole file if it changed meanwhile.
+'''
+# how many bytes are read from response at once
+DOWNLOAD_CHUNK_SIZE = 64*1024
+
+# removes partial download and its metadata
+def remove_partial(part):
+	for name in (part, "%s.meta" % part):
+		if os.path.isfile(name):
+			os.remove(name)
+
+# streams body of response to part file, appending if it's an answer to Range request. Raises if body gets bigger
+# than max_size bytes, partial download is removed then. Any other failure keeps it, so it can be resumed.
+# deadline is time.monotonic() time download has to be done by. It's checked after every read, and socket
+# timeout (DOWNLOAD_TIMEOUT) is how long a read can wait, so server sending a byte now and then can't hold us forever.
+def save_body(response, part, offset, max_size, deadline=None):
+	if response.status == 206:
+		# make sure server continues where we stopped
+		content_range = response.headers.get("Content-Range", "")
+		if not content_range.startswith("bytes %d-" % offset):
+			raise ValueError("unexpected Content-Range '%s'" % content_range)
+	else:
+		offset = 0
+
+	length = response.headers.get("Content-Length")
+	if max_size and length is not None and length.isdigit() and offset + int(length) > max_size:
+		remove_partial(part)
+		raise ValueError("response is bigger than %d bytes" % max_size)
+
+	write_cache_meta(part, {
+		"etag": response.headers.get("ETag"),
+		"last_modified": response.headers.get("Last-Modified"),
+		"encoding": response.headers.get("Content-Encoding"),
+	})
+
+	size = offset
+	with open(part, 'ab' if offset > 0 else 'wb') as part_file:
+		# read1() returns whatever came, instead of waiting for whole chunk
+		for chunk in iter(lambda: response.read1(DOWNLOAD_CHUNK_SIZE), b""):
+			size += len(chunk)
+			if max_size and size > max_size:
+				part_file.close()
+				remove_partial(part)
+				raise ValueError("response is bigger than %d bytes" % max_size)
+			part_file.write(chunk)
+			if deadline is not None and time.monotonic() > deadline:
+				raise TimeoutError("download took more than %s seconds, got %d bytes" % (DOWNLOAD_TIMEOUT, size))
+
+		# read1() doesn't close response read to the end, read() does. only closed one gives connection back to pool.
+		response.read()
+
+	# body ends when connection is closed, and that can happen too early. what we got is kept, for resuming.
+	if length is not None and length.isdigit() and size < offset + int(length):
+		raise ConnectionError("download interrupted after %d of %d bytes" % (size, offset + int(length)))
+
+# decompresses complete download in part file to tmp, gzipping it if compress is set. returns sha256 of content.
+def decode_download(part, tmp, encoding, max_size, compress):
+	decode = body_decoder(encoding)
+	digest = hashlib.sha256()
+	size = 0
+
+	with open(part, 'rb') as part_file, open(tmp, 'wb') as tmp_file:
+		# mtime=0 and no file name keep compressed file the same for the same content, so parsed cache key doesn't change.
+		target = gzip.GzipFile(filename="", mode='wb', fileobj=tmp_file, mtime=0) if compress else tmp_file
+		with target:
+			for chunk in itertools.chain(iter(lambda: part_file.read(DOWNLOAD_CHUNK_SIZE), b""), [b""]):
+				data = decode(chunk)
+				size += len(data)
+				if max_size and size > max_size:
+					raise ValueError("content is bigger than %d bytes" % max_size)
+				digest.update(data)
+				target.write(data)
+
+	return digest.hexdigest()
+
+# downloads url to path, streaming. headers are extra request headers (like conditional ones), max_size is
+# limit in bytes (0 or None for no limit), compress gzips downloaded content. path is replaced only if sha256
+# of content isn't old_digest. returns (changed, info), where info is dict with ETag, Last-Modified and sha256 of
+# content, or None if server answered 304 Not Modified. Raises on failure, path is never left half written.
+# Download has DOWNLOAD_TIMEOUT seconds in total, from the request on (see save_body()).
+def stream_download(url, path, headers=None, max_size=None, compress=False, old_digest=None):
+	deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+	part = "%s.part" % path
+	tmp = "%s.tmp" % path
+	request_headers = {"Accept-Encoding": accept_encoding()}
+	request_headers.update(headers or {})
+
+	# resume interrupted download, but only if we can tell it's still the same file. weak ETags can't be used with If-Range.
+	offset = 0
+	if os.path.isfile(part):
+		part_meta = read_cache_meta(part)
+		validator = part_meta.get("etag")
+		if not validator or validator.startswith("W/"):
+			validator = part_meta.get("last_modified")
+		if validator and os.path.getsize(part) > 0:
+			offset = os.path.getsize(part)
+			request_headers["Range"] = "bytes=%d-" % offset
+			request_headers["If-Range"] = validator
+			logger.debug("-> resuming download of %s from %d bytes", url, offset)
+
+	try:
+		with open_url(url, request_headers) as response:
+			save_body(response, part, offset, max_size, deadline)
+	except urllib.error.HTTPError as e:
+		if e.code == 304:
+			return (False, None)
+		if e.code == 416 and offset > 0:
+			# partial download doesn't fit anymore, start over
+			remove_partial(part)
+			return stream_download(url, path, headers, max_size, compress, old_digest)
+		raise
+
+	# complete download is decompressed only once, broken one isn't resumed
+	try:
+		digest = decode_download(part, tmp, read_cache_meta(part).get("encoding"), max_size, compress)
+		changed = digest != old_digest
+		if changed:
+			os.replace(tmp, path)
+	finally:
+		remove_partial(part)
+		if os.path.isfile(tmp):
+			os.remove(tmp)
+
+	return (changed, {
+		"etag": response.headers.get("ETag"),
+		"last_modified": response.headers.get("Last-Modified"),
+		"sha256": digest,
+	})
+
+# downloads a single host source to cache, but only if cached copy is older than max_age days
+# (if None, source's ttl, or CACHE_AGE if it has none).
+# if we know ETag or Last-Modified of cached copy, request is conditional, so unchanged lists aren't transfered again.
+# url is Source entry from host database. Returns True if cached content changed,
+# raises on failure, caller reports it.
+def fetch_source(url, max_age=None):
+	path = "%s/%s" % (CACHE_PATH, url[1])
+
+	if max_age is None:
+		max_age = CACHE_AGE if url.ttl is None else url.ttl / 24
+	if not check_age(path, max_age):
+		logger.debug("-> %s is still fresh, using cached copy", path)
+		return False
+
+	logger.debug("-> downloading %s to %s", url[0], path)
+
+	# without cached file, there's nothing to revalidate
+	meta = {}
+	headers = {}
+	if os.path.isfile(path):
+		meta = read_cache_meta(path)
+		if meta.get("etag"):
+			headers["If-None-Match"] = meta["etag"]
+		if meta.get("last_modified"):
+			headers["If-Modified-Since"] = meta["last_modified"]
+
+	# hash is of decompressed content, so it doesn't change if server changes compression.
+	# cached as it is, bytes that aren't valid UTF-8 are dealt with line by line when parsing
+	max_size = DOWNLOAD_MAX_SIZE if url.max_size is None else url.max_size
+	(changed, info) = stream_download(str(url[0]), path, headers, max_size, CACHE_COMPRESSION, meta.get("sha256"))
+
+	if info is None:
+		# not modified. touch cached file so we don't ask again until CACHE_AGE passes
+		logger.debug("-> %s not modified upstream", url[1])
+		os.utime(path, None)
+		return False
+
+	if not changed:
+		# server doesn't do conditional requests, but content is the same anyway
+		logger.debug("-> %s content unchanged", url[1])
+		os.utime(path, None)
+
+	write_cache_meta(path, info)
+	return changed
+
+# downloads all host sources using a pool of DOWNLOAD_WORKERS threads. max_age is passed to fetch_source().
+# returns (state, changed) where state is True if at least one source is available,
+# and changed is a list of descriptions of sources whose content changed.
+# if failed dict is given, errors of failed sources are added to it, by description.
+def download_sources(content, max_age=None, failed=None):
+	logger.info("Started downloading %d host sources with %d workers", len(content), DOWNLOAD_WORKERS)
+	dl_succ = False
+	changed = []
+	url_count = len(content)
+	c = 1.0
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, DOWNLOAD_WORKERS)) as pool:
+		jobs = {pool.submit(fetch_source, url, max_age): url for url in content}
+
+		# report sources as they finish, not in the order they were given
+		for job in concurrent.futures.as_completed(jobs):
+			url = jobs[job]
+			try:
+				if job.result():
+					changed.append(url[1])
+				dl_succ = True
+				update_progress("Downloaded data from %s" % url[1], c/url_count)
+			except Exception as e:
+				print("!! Failed to fetch data from %s: %s" % (url[1], repr(e)))
+				logger.error("Failed to fetch data from %s: %s" % (url[1], repr(e)))
+				if failed is not None:
+					failed[url[1]] = repr(e)
+				# not sure if I should bail here or not?
+			c+=1
+
+	return (dl_succ, changed)
+
+'''
+Host list base. One host source per line: URL, description and optional settings, separated by commas.
+	https://example.com/hosts.txt, Example hosts
+	https://example.com/filters.txt, Example filters, format=abp, ttl=6, priority=10
+	https://example.com/old.txt, Old list, enabled=no
+Settings, all optional:
+- format: auto (default), hosts, domains or abp. Picks parser tuned for the format, auto sniffs it from cached source.
+- ttl: how long downloaded copy is fresh, in hours. Used instead of CACHE_AGE, and in daemon mode instead of DAEMON_INTERVAL.
+- enabled: no, false or 0 leaves source out, without removing it from the file.
+- priority: sources with higher priority are downloaded, parsed and listed first. Default is 0.
+- max_size: biggest download allowed for the source, in MB. Used instead of DOWNLOAD_MAX_SIZE.
+Plain "URL, description" lines are still valid, they use defaults.
+Host list base is read once per run, and the same list of Source entries is used by every stage.
+'''
+# host source from host list base. url and description come first, so source[0] and source[1] still work.
+Source = collections.namedtuple("Source", ("url", "description", "format", "ttl", "enabled", "priority", "max_size"))
+
+# values of enabled setting
+BOOLEAN_VALUES = {"yes": True, "true": True, "1": True, "no": False, "false": False, "0": False}
+
+# parses one line of host list base into Source. raises ValueError if line or its settings aren't valid.
+def parse_source_entry(line):
+	fields = line.rstrip("\n").split(",")
+	if len(fields) < 2:
+		raise ValueError("expected 'URL, description'")
+
+	settings = {"format": "auto", "ttl": None, "enabled": True, "priority": 0, "max_size": None}
+	for field in fields[2:]:
+		(name, sep, value) = field.partition("=")
+		(name, value) = (name.strip(), value.strip())
+
+		# older lines could have more than one comma, and everything after the second one was dropped
+		if not sep:
+			logger.debug("ignoring '%s' in host list base", field.strip())
+			continue
+
+		if name == "format":
+			if value not in SOURCE_FORMATS:
+				raise ValueError("unknown format '%s'" % value)
+		elif name == "ttl":
+			value = float(value)
+		elif name == "enabled":
+			if value.lower() not in BOOLEAN_VALUES:
+				raise ValueError("enabled should be yes or no, not '%s'" % value)
+			value = BOOLEAN_VALUES[value.lower()]
+		elif name == "priority":
+			value = int(value)
+		elif name == "max_size":
+			value = int(float(value) * 1024*1024)
+		else:
+			raise ValueError("unknown setting '%s'" % name)
+		settings[name] = value
+
+	return Source(fields[0].strip(), fields[1].strip(), **settings)
+
+# parse host database. returns (state, content), where content is list of enabled Source entries,
+# by priority. Invalid lines are reported and skipped.
 def parse_host_database():
 	content = []
 	# read the source file. Bail out if file isn't there
@@ -475,59 +2185,473 @@ def parse_host_database():
 
 			for z in f_cont:
 				if not z.startswith(ignore_tuple):
-					zz = z.rstrip("\n").split(",")
-					zz[1] = zz[1].strip()
-					content.append(zz)
+					try:
+						source = parse_source_entry(z)
+						if source.enabled:
+							content.append(source)
+						else:
+							logger.info("%s is disabled, skipping", source.description)
+					except ValueError as err:
+						print("!! Skipping line %d of %s: %s" % (f, HOSTS_FILENAME, err))
+						logger.error("Skipping line %d of %s: %s" % (f, HOSTS_FILENAME, err))
 
 				f_perc = round(f/f_size, 2)
 				update_progress("Preparing host list base", f_perc)
 
 				f+=1
 
+			# sort is stable, so sources with the same priority keep their order
+			content.sort(key=lambda source: -source.priority)
 			return (True, content)
 	except:
 		print("!! Error reading %s: %s" % (HOSTS_FILENAME, sys.exc_info()[0]))
 		logger.error("Error reading %s: %s" % (HOSTS_FILENAME, sys.exc_info()[0]))
 		return (False, content)
 
+'''
+Output writers. Every format has a comment mark (for banner), optional header written after the banner,
+and a function formatting one domain. Add yours, freely.
+- hosts: SINK_IP domain, for hosts files and AdAway-like blockers
+- domains: just domains, one per line
+- dnsmasq: address=/domain/, dnsmasq answers NXDOMAIN for domain and all of its subdomains
+- unbound: local-zone "domain" always_nxdomain, also covers subdomains
+- rpz: DNS response policy zone, domain and *.domain are answered with NXDOMAIN
+Formats that block subdomains too (suffix: True) can have subdomains of blocked domains left out, see COLLAPSE_SUBDOMAINS.
+They also need an exception for whitelisted domains under blocked ones, written before domains.
+'''
+OUTPUT_FORMATS = {
+	"hosts": {"comment": "#", "suffix": False, "header": lambda: "", "line": lambda d: "%s %s\n" % (SINK_IP, d), "exception": None},
+	"domains": {"comment": "#", "suffix": False, "header": lambda: "", "line": lambda d: "%s\n" % d, "exception": None},
+	"dnsmasq": {"comment": "#", "suffix": True, "header": lambda: "", "line": lambda d: "address=/%s/\n" % d,
+		"exception": lambda d: "server=/%s/#\n" % d},
+	"unbound": {"comment": "#", "suffix": True, "header": lambda: "server:\n", "line": lambda d: "local-zone: \"%s\" always_nxdomain\n" % d,
+		"exception": lambda d: "local-zone: \"%s\" transparent\n" % d},
+	"rpz": {"comment": ";", "suffix": True, "header": lambda: "$TTL 300\n@ IN SOA localhost. root.localhost. (%d 3600 600 86400 300)\n  IN NS localhost.\n" % int(time.time()),
+		"line": lambda d: "%s CNAME .\n*.%s CNAME .\n" % (d, d), "exception": lambda d: "%s CNAME rpz-passthru.\n*.%s CNAME rpz-passthru.\n" % (d, d)},
+}
+
+# how many lines are collected before they're written out, per output
+WRITE_BUFFER_LINES = 10000
+
+# returns list of (format, path) outputs to write. TARGET_FILE is always first, as hosts.
+def get_outputs():
+	outputs = [("hosts", TARGET_FILE)]
+	for (fmt, path) in EXTRA_OUTPUTS:
+		if fmt not in OUTPUT_FORMATS:
+			raise ValueError("unknown output format '%s'" % fmt)
+		outputs.append((fmt, path))
+	return outputs
+
+# returns paths of configured outputs (see get_outputs()) and INDEX_FILE which don't exist yet
+def missing_outputs():
+	paths = [path for (fmt, path) in get_outputs()]
+	if INDEX_FILE:
+		paths.append(INDEX_FILE)
+	return [path for path in paths if not os.path.isfile(path)]
+
+# file with fingerprint of configuration outputs were last written with
+def build_fingerprint_path():
+	return "%s.build" % TARGET_FILE
+
+# fingerprint of everything outputs depend on, besides content of sources: which sources are used and how,
+# parsing rules and whitelist, and outputs with their settings
+def get_build_fingerprint(content):
+	build = [sorted("%s %s %s" % (source.url, source.format, source.max_size) for source in content), get_rules_fingerprint(),
+		sorted(get_outputs()), SINK_IP, COLLAPSE_SUBDOMAINS, INDEX_FILE]
+	return hashlib.sha256(json.dumps(build).encode("UTF-8")).hexdigest()[:16]
+
+# returns True if outputs weren't written with configuration they have now (or weren't written yet)
+def build_changed(content):
+	try:
+		with open(build_fingerprint_path()) as f:
+			return f.read().strip() != get_build_fingerprint(content)
+	except OSError:
+		return True
+
+def write_build_fingerprint(content):
+	with open(build_fingerprint_path(), "w") as f:
+		f.write(get_build_fingerprint(content) + "\n")
+
+# finds domains already covered by their blocked parent (ads.example.com by example.com).
+# Domains are sorted by reversed labels, which walks reversed label trie depth first: every domain is followed
+# by its subdomains, so it's enough to remember the topmost blocked parent we're under. That takes a sorted list
+# of keys, instead of a dict for every trie node. Parents with whitelisted subdomains are never used for collapsing.
+# returns set of covered domains.
+def find_covered_domains(domains):
+	parents = get_whitelist_index()["parents"]
+	covered = set()
+
+	if parents is None:
+		logger.info("Whitelist has wildcards without fixed ending, not collapsing subdomains")
+		return covered
+
+	root = None
+	for k in sorted(reverse_labels(d.encode("UTF-8")) for d in domains):
+		if root is not None and k.startswith(root):
+			covered.add(b".".join(reversed(k.split(b"\x00"))).decode("UTF-8"))
+		elif k in parents:
+			root = None
+		else:
+			root = k + b"\x00"
+
+	return covered
+
+# finds whitelisted domains (and fixed endings of "*.something" wildcards) with a blocked parent. Suffix outputs
+# would block them together with the parent, so they need an exception there. Whitelist is small, so its
+# parents are indexed, and domains are only looked up there. returns sorted list of domains.
+def find_whitelist_exceptions(domains):
+	index = get_whitelist_index()
+	whitelisted = set(index["domains"]) | set(index["suffixes"])
+	parents = collections.defaultdict(list)
+	for w in whitelisted:
+		dot = w.find(".")
+		while dot >= 0:
+			parents[w[dot + 1:]].append(w)
+			dot = w.find(".", dot + 1)
+
+	exceptions = set()
+	blocked = set()
+	for d in domains:
+		if d in parents:
+			exceptions.update(parents[d])
+		if d in whitelisted:
+			blocked.add(d)
+
+	# domain that's blocked itself (kept from old output by ONLY_ADD_NEW) stays blocked
+	return sorted(exceptions - blocked)
+
+# writes given domains to every output in a single pass. Every output is written to a temporary file first,
+# and renamed over the old one only when it's complete, so a half written file is never seen.
+# content is list of host sources, listed in banner.
+def write_outputs(to_write, outputs, content=()):
+	total_hosts = len(to_write)
+	files = []
+
+	# subdomains left out of suffix outputs
+	covered = set()
+	if COLLAPSE_SUBDOMAINS and any(OUTPUT_FORMATS[fmt]["suffix"] for (fmt, path) in outputs):
+		covered = find_covered_domains(to_write)
+		print("* %d subdomains are covered by their blocked parents" % len(covered))
+
+	# whitelisted domains under blocked ones, let through in suffix outputs
+	exceptions = []
+	if any(OUTPUT_FORMATS[fmt]["suffix"] for (fmt, path) in outputs):
+		exceptions = find_whitelist_exceptions(to_write)
+		if len(exceptions) > 0:
+			print("* %d whitelisted domains are under blocked ones, adding exceptions" % len(exceptions))
+
+	try:
+		for (fmt, path) in outputs:
+			if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+
+			target = open("%s.tmp" % path, "w", buffering=1024*1024)
+			files.append((target, OUTPUT_FORMATS[fmt]["line"], [], OUTPUT_FORMATS[fmt]["suffix"]))
+
+			# generates banner at the top of file. Contains info about hosts and creation date.
+			target.write(generate_banner(OUTPUT_FORMATS[fmt]["comment"], content))
+			target.write(OUTPUT_FORMATS[fmt]["header"]())
+			if OUTPUT_FORMATS[fmt]["suffix"]:
+				target.write("".join(OUTPUT_FORMATS[fmt]["exception"](d) for d in exceptions))
+
+		# now format every domain for every output, and write them in big blocks
+		action = "Writing %d hosts" % total_hosts
+		cnt = 0
+		for h in to_write:
+			skip = h in covered
+			for (target, line, buf, suffix) in files:
+				if not (suffix and skip):
+					buf.append(line(h))
+			cnt += 1
+
+			if cnt % WRITE_BUFFER_LINES == 0:
+				for (target, line, buf, suffix) in files:
+					target.write("".join(buf))
+					del buf[:]
+				update_progress(action, cnt/total_hosts)
+
+		for (target, line, buf, suffix) in files:
+			target.write("".join(buf))
+			target.close()
+		update_progress(action, 1)
+
+	except Exception:
+		# don't leave temporary files behind
+		for (target, line, buf, suffix) in files:
+			target.close()
+			if os.path.isfile(target.name):
+				os.remove(target.name)
+		raise
+
+	for (fmt, path) in outputs:
+		os.replace("%s.tmp" % path, path)
+		written = total_hosts - len(covered) if OUTPUT_FORMATS[fmt]["suffix"] else total_hosts
+		print("* Written %d hosts to %s (%s)" % (written, path, fmt))
+
+'''
+Profiling. With --profile, every stage of main() is measured: wall and CPU time, memory and items in and out.
+Items are lines, sources or hosts, depending on stage. Sources are measured one by one too.
+Peak RSS the OS keeps is the peak of whole process so far, so memory of every stage is:
+- max_rss_kb: peak RSS of process at the end of stage, cumulative - stage can't be lower than stages before it
+- max_rss_growth_kb: how much stage raised that peak. 0 if it stayed under peak of an earlier stage.
+- tracemalloc_peak_kb: peak of traced memory during the stage itself, only if tracemalloc is running
+  (python -X tracemalloc or PYTHONTRACEMALLOC=1)
+CPU time and memory are for this process only - parse workers with PARSE_WORKERS > 1 aren't included.
+'''
+# profiling report, None if profiling is off
+profile_report = None
+
+# stages being measured. stages of sources run inside parse stage, and they share tracemalloc peak with it.
+open_stages = []
+
+# turns on profiling
+def start_profiling():
+	global profile_report
+	profile_report = {"started": time.ctime(), "stages": [], "sources": []}
+	del open_stages[:]
+
+# returns peak RSS of this process in kB, or None if platform can't tell
+def peak_rss():
+	try:
+		import resource
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# it's in bytes on MacOS, kB everywhere else
+		return rss // 1024 if sys.platform == "darwin" else rss
+	except ImportError:
+		return None
+
+# starts measuring a stage. group is "stages" or "sources". returns None if profiling is off.
+def begin_stage(name, group="stages"):
+	if profile_report is None:
+		return None
+
+	# traced peak is reset for every stage, stages it runs in keep what they had so far
+	if tracemalloc.is_tracing():
+		peak = tracemalloc.get_traced_memory()[1]
+		for stage in open_stages:
+			stage["traced_peak"] = max(stage["traced_peak"], peak)
+		tracemalloc.reset_peak()
+
+	stage = {"name": name, "group": group, "wall": time.perf_counter(), "cpu": time.process_time(), "max_rss": peak_rss(), "traced_peak": 0}
+	open_stages.append(stage)
+	return stage
+
+# finishes measuring a stage and adds it to report
+def end_stage(stage, items_in=None, items_out=None):
+	if stage is None:
+		return
+
+	max_rss = peak_rss()
+	result = {
+		"name": stage["name"],
+		"wall": round(time.perf_counter() - stage["wall"], 4),
+		"cpu": round(time.process_time() - stage["cpu"], 4),
+		"max_rss_kb": max_rss,
+		"max_rss_growth_kb": max_rss - stage["max_rss"] if max_rss is not None else None,
+		"in": items_in,
+		"out": items_out,
+	}
+	if tracemalloc.is_tracing():
+		result["tracemalloc_peak_kb"] = max(stage["traced_peak"], tracemalloc.get_traced_memory()[1]) // 1024
+
+	open_stages[:] = [s for s in open_stages if s is not stage]
+	profile_report[stage["group"]].append(result)
+
+# writes profiling report as JSON
+def write_profile_report(path):
+	with open(path, 'w') as report:
+		json.dump(profile_report, report, indent=2)
+		report.close()
+	print("* Profiling report written to %s" % path)
+
+# writes merged hosts to TARGET_FILE and other outputs, adding them to old ones if ONLY_ADD_NEW is set,
+# and pushes them to git if AUTO_PUSH is set. content is list of host sources, for banner. Returns False if writing failed.
+def write_hosts(hosts, content=()):
+	try:
+		logger.info("writing to final hosts file...")
+		# initialise to_write as empty list
+		to_write = []
+
+		# tmp will store our new host values until we decide what to do
+		# hosts is already merged store, so there are no duplicates. Sweet, eh?
+		tmp = hosts
+
+		# now, do a block for ONLY_ADD_NEW and only in case TARGET_FILE EXISTS!
+		if ONLY_ADD_NEW and os.path.exists(TARGET_FILE):
+			# total old hosts
+			stage = begin_stage("diff")
+			old_hosts = read_old_hosts()
+			old_hosts_count = len(old_hosts)
+			msg = "* Old host definitions: %d hosts" % old_hosts_count
+			print(msg)
+			logger.debug(msg)
+
+			new_host_count = len(tmp)
+			msg = "* New host definitions: %d hosts" % new_host_count
+			print(msg)
+			logger.debug(msg)
+
+			# determine how many hosts are missing.
+			# We're doing this no matter if old_hosts_count > new_host_count,
+			# simply because we can have it 0, and still get new updates
+			missing_hosts = find_new_hosts(old_hosts, tmp)
+			end_stage(stage, items_in=len(old_hosts) + len(tmp), items_out=len(missing_hosts))
+
+			# count 'em and show info
+			missing_hosts_c = len(missing_hosts)
+
+			# inform user and extend current host list
+			if missing_hosts_c > 0:
+				print("* Added %d new domains." % missing_hosts_c)
+				to_write = DomainStore.merge([old_hosts, DomainStore.from_domains(missing_hosts)])
+				old_hosts = None
+
+			else:
+				missing = missing_outputs()
+				if regenerate:
+					print("* No new hosts found. Still, regenerating file as requested...")
+					to_write = old_hosts
+				elif len(missing) > 0:
+					# output added to configuration is written right away, not when some list gets a new domain
+					print("* No new hosts found, but %s doesn't exist yet. Writing all outputs..." % ", ".join(missing))
+					to_write = old_hosts
+				elif build_changed(content):
+					# outputs follow configuration (SINK_IP, formats, whitelist...) right away too
+					print("* No new hosts found, but configuration changed since last build. Writing all outputs...")
+					to_write = old_hosts
+				else:
+					print("* No new domains found, not updating file.")
+
+		# because TARGET_FILE doesn't exist or ONLY_ADD_NEW isn't set, fail to default behaviour
+		else:
+			to_write = tmp
+
+		# finally, total number of hosts to write.
+		total_hosts = len(to_write)
+
+		if total_hosts > 0:
+			# old output is replaced only when new one is completely written
+			stage = begin_stage("write")
+			write_outputs(to_write, get_outputs(), content)
+			if INDEX_FILE:
+				write_index(to_write, INDEX_FILE, hosts)
+				print("* Written index of %d hosts to %s" % (total_hosts, INDEX_FILE))
+			end_stage(stage, items_in=total_hosts)
+
+			# file written an saved, now it's time to push it to git
+			if AUTO_PUSH:
+				stage = begin_stage("push_to_git")
+				push_to_git()
+				end_stage(stage)
+
+		else:
+			print("* No changes. You're up to date!")
+
+		# outputs are up to date with this configuration now
+		write_build_fingerprint(content)
+
+	except Exception as e:
+		print("!! Failed to write hosts file: %s" % repr(e))
+		logger.error("Failed to write hosts file: %s" % repr(e))
+		return False
+
+	return True
+
+'''
+Library use. Module can be imported without side effects: sh and git_config are set up only when used, and
+messages go to module's own logger, which application configures (debug log in LOG_PATH is command line only).
+	import generate_adblock_urls as adblock
+	result = adblock.build({"TARGET_FILE": "/etc/hosts.d/ads", "AUTO_PUSH": False, "quiet": True})
+config is a dict (or object with attributes, like argparse.Namespace) of CONFIGURATION BLOCK values and runtime
+flags. They're used only for that build, everything else keeps its value. Stages can be called one by one too:
+load_host_database(), download_sources(), parse_sources() and write_hosts().
+'''
+# lowercase values build() config can set, everything uppercase from CONFIGURATION BLOCK can be set too
+RUNTIME_FLAGS = ("ignore_tuple", "ignore_host_tuple", "ignore_extensions_touple", "regenerate", "no_push", "quiet")
+
+# raised when build can't go on. code is exit code command line uses.
+class BuildError(Exception):
+	def __init__(self, message, code=1):
+		Exception.__init__(self, message)
+		self.code = code
+
+# sets configuration values from config (dict or object with attributes). returns old values, so they can be
+# put back with another configure() call.
+def configure(config):
+	global whitelist_index, line_rules, rules_fingerprint
+	values = config if isinstance(config, dict) else vars(config)
+	old = {}
+
+	for (name, value) in values.items():
+		# only values from configuration block and runtime flags, internal constants aren't configuration
+		if name not in CONFIG_NAMES and name not in RUNTIME_FLAGS:
+			raise ValueError("unknown configuration value '%s'" % name)
+		old[name] = globals()[name]
+		globals()[name] = value
+
+	# rules and whitelist are compiled on first use, and they could be different now
+	whitelist_index = None
+	line_rules = None
+	rules_fingerprint = None
+
+	if "LOG_LEVEL" in values:
+		set_log_level(LOG_LEVEL)
+
+	return old
+
+# returns current configuration values and runtime flags, as dict configure() takes
+def config_snapshot():
+	return dict((name, globals()[name]) for name in CONFIG_NAMES + RUNTIME_FLAGS)
+
+# runs the whole pipeline with given config, see main(). returns result dict: number of sources, changed
+# sources, number of hosts (None if nothing was parsed), if outputs were written, and parsing statistics.
+# raises BuildError if build can't go on. config is set for the whole module while build runs, so builds
+# can't run at the same time, in threads or nested.
+def build(config=None):
+	old = configure(config or {})
+	try:
+		return main()
+	finally:
+		close_connections()
+		configure(old)
+
 # MAIN FUNCTION. ALL FUN HAPPENS HERE
 def main():
 	# grab domain list file if online
 	if HOSTS_ONLINE:
+		stage = begin_stage("download_database")
 		dbStatus = download_database()
+		end_stage(stage)
 
 		if not dbStatus:
 			print("!! Failed to download hosts database. Abort")
 			logger.error("Failed to download hosts database. Aborting!")
-			sys.exit(1)
+			raise BuildError("failed to download hosts database")
 	else:
 		# this is for good old analogue access - all files on drives,
 		# and when something is missing? blame user.
 		if not os.path.isfile(HOSTS_FILENAME):
 			logger.error("%s doesn't exist. Aborting!", HOSTS_FILENAME)
 			print("!! Hosts database not found, bailing out.")
-			sys.exit(1)
+			raise BuildError("%s doesn't exist" % HOSTS_FILENAME)
 		else:
 			print("* Hosts database found, resuming operation...")
 
 	# haven't exited yet, parse hosts database, return state and base'
+	stage = begin_stage("parse_host_database")
 	(source_file_exists, content) = parse_host_database()
+	end_stage(stage, items_out=len(content))
 
-	# store old hosts here. leave it uninitialized because it maybe won't be even used
-	old_hosts = []
+	# what was done, returned to caller
+	result = {"sources": len(content), "changed": [], "hosts": None, "written": False, "stats": {}}
 
 	# everything we do now, do only if source_file_exists is True:
 	if source_file_exists and len(content) > 0:
-		# check if TARGET_FILE exists, and remove if it's there
-		if os.path.isfile(TARGET_FILE):
-			if not ONLY_ADD_NEW:
-				print("* Found old output, removing file.")
-				os.remove(TARGET_FILE)
-			else:
-				print("* Old output found, reusing since ONLY_ADD_NEW flag is set.")
+		# old output stays until new one is written over it (see write_outputs()), so failed run doesn't lose it
+		if os.path.isfile(TARGET_FILE) and ONLY_ADD_NEW:
+			print("* Old output found, reusing since ONLY_ADD_NEW flag is set.")
 
 		# start reading  and downloading hosts
-		c = 1.0;
 		url_count = len(content)
 
 		# inform user about everything
@@ -538,30 +2662,11 @@ def main():
 			print("*! Couldn't find cache directory, creating.")
 			os.mkdir(CACHE_PATH)
 
-		# download host sources. This should probably be moved to a function.
-		dl_succ = False
-		for url in content:
-			try:
-				c_perc = c/url_count
-				update_progress("Downloading data from %s" % url[1], c_perc)
-
-				path = "%s/%s" % (CACHE_PATH, url[1])
-
-				if check_age(path, CACHE_AGE):
-					#downloaded_file = urllib.URLopener()
-					#downloaded_file.retrieve(str(url[0]), path)
-					with open(path, 'w') as cache_file:
-						d = urllib.request.urlopen(str(url[0])).read().decode("UTF-8")
-						cache_file.write(d)
-						cache_file.close()
-
-
-				c+=1
-				dl_succ = True
-			except Exception as e:
-				print("!! Failed to fetch data from %s: %s" % (url[1], repr(e)))
-				logger.error("Failed to fetch data from %s: %s" % (url[1], repr(e)))
-				# not sure if I should bail here or not?
+		# download host sources, DOWNLOAD_WORKERS of them at the time.
+		stage = begin_stage("download_sources")
+		(dl_succ, changed_sources) = download_sources(content)
+		end_stage(stage, items_in=url_count, items_out=len(changed_sources))
+		result["changed"] = changed_sources
 
 		# yeah, we're bailing out like there is no tomorrow.
 		if dl_succ:
@@ -569,178 +2674,284 @@ def main():
 		else:
 			print("!! Couldn't download host sources, bailing out")
 			logger.error("Couldn't download host sources, bailing out")
-			sys.exit(0)
-
-		# start merging source files and removing them after
-		d = 0
-		print("* Processing sources...")
-		logger.info("Started processing source files...")
-
-		# this, ladies and gentleman, is our main container for hosts
-		# damn python, I can't remember how's this thing called. Touple? Array? Fuck it.
-		# we aren't initializing it with existing data in case ONLY_ADD_NEW is true simply because performance impact is, whoh, great.
-		hosts = []
-
-		# Now, let's loop!
-		while d < url_count:
-			try:
-				# content[] actually contains host url and file name.
-				# file name is used to read data from cache.
-				# smart, eh?
-				c_url = content[d]
-				path = "%s/%s" % (CACHE_PATH, c_url[1])
-
-				# open host source file and read it, determine it's size, strip it and parse it
-				with open(path) as source:
-					logger.debug("-> parsing contents of %s", path)
-					input_line = source.readlines()
-					s_size = len(input_line)
-
-					# this is for progress bar.
-					j = 1.0
-
-					try:
-						# go line per line and parse.
-						for y in input_line:
-							s_perc = j/s_size
-							update_progress("Parsing list: %s" % c_url[1].strip(), s_perc)
-
-							# strip it naked before parsing.
-							w = y.strip()
-							w = w.strip("\n")
-							w = w.strip("\r")
-							y = w
-
-							# line is useful to us only if it's longer than 0 chars
-							if len(y) > 0:
-								# parse, get response and value.
-								(write, y) = parse_line(y)
-
-								# if response is right, write
-								if write:
-									nline = None
-
-									# we're dropping the IP part of host, if any.
-									w = y.split()
-
-									if len(w) > 1:
-										nline = "127.0.0.1 %s" % w[1] # see why?
-									elif len(w) == 1:
-										nline = "127.0.0.1 %s" % w[0]
-
-									# write only if nline is initialised
-									if nline != None:
-											hosts.append(nline)
-
-							# and increment percentage, rinse-repeat.
-							j+=1
-
-					except Exception as drnd:
-						print("!! Failed  processing entry %s: %s" % (str(y), repr(drnd)))
-						logger.error("Failed  processing entry %s: %s" % (str(y), repr(drnd)))
-
-					# remove tmp file
-					if not USE_CACHE:
-						logger.debug("removing cached file...")
-						os.remove(path)
-
-			except Exception as err:
-				print("!! Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
-				logger.error(" Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
-			d+=1
+			raise BuildError("couldn't download host sources", code=0)
+
+		# nothing changed upstream or in configuration since last run and we already have outputs? don't parse everything again.
+		if len(changed_sources) == 0 and not regenerate and len(missing_outputs()) == 0 and not build_changed(content):
+			print("* No changes in host sources. You're up to date!")
+			logger.info("No host source changed, skipping parsing")
+			return result
+		print("* %d of %d host sources changed" % (len(changed_sources), url_count))
+
+		# parsing statistics, by source
+		stats = result["stats"]
+		hosts = parse_sources(content, stats)
+		result["hosts"] = len(hosts)
+
+		# what was dropped and why
+		print_parse_stats(stats)
+		if STATS_FILE:
+			write_parse_stats(stats, STATS_FILE)
+			print("* Parsing statistics written to %s" % STATS_FILE)
+
+		# how much every source contributes
+		if PROVENANCE_FILE:
+			report = provenance_report(hosts)
+			print_provenance(report)
+			write_provenance(report, PROVENANCE_FILE)
+			print("* Provenance report written to %s" % PROVENANCE_FILE)
 
 		# now, let's write!
-		try:
-			logger.info("writing to final hosts file...")
-			# initialise to_write as empty list
-			to_write = []
-
-			# tmp will store our new host values until we decide what to do
-			# it also useset set(), because we need to drop duplicates. Sweet, eh?
-			tmp = set(hosts)
-
-			# now, do a block for ONLY_ADD_NEW and only in case TARGET_FILE EXISTS!
-			if ONLY_ADD_NEW and os.path.exists(TARGET_FILE):
-				# total old hosts
-				old_hosts = read_old_hosts()
-				old_hosts_count = len(old_hosts)
-				msg = "* Old host definitions: %d hosts" % old_hosts_count
-				print(msg)
-				logger.debug(msg)
+		result["written"] = write_hosts(hosts, content)
 
-				new_host_count = len(tmp)
-				msg = "* New host definitions: %d hosts" % new_host_count
-				print(msg)
-				logger.debug(msg)
+	return result
 
-				# determine how many hosts are missing.
-				# We're doing this no matter if old_hosts_count > new_host_count,
-				# simply because we can have it 0, and still get new updates
-				missing_hosts = find_new_hosts(old_hosts, tmp)
+# parses cached host sources from content, one by one or in PARSE_WORKERS processes, and returns all of their
+# domains merged into one DomainStore. parsing statistics are added to stats dict, by source description.
+def parse_sources(content, stats):
+	url_count = len(content)
 
-				# count 'em and show info
-				missing_hosts_c = len(missing_hosts)
+	# start merging source files and removing them after
+	d = 0
+	print("* Processing sources...")
+	logger.info("Started processing source files...")
 
-				# inform user and extend current host list
-				if missing_hosts_c > 0:
-					print("* Added %d new domains." % missing_hosts_c)
-					old_hosts.extend(list(missing_hosts))
-					to_write = list(old_hosts)
+	# every source is parsed to its own packed DomainStore, and they're all merged after parsing.
+	# this, ladies and gentleman, will be our main container for hosts.
+	# we aren't initializing it with existing data in case ONLY_ADD_NEW is true simply because performance impact is, whoh, great.
+	runs = []
 
-				else:
-					if regenerate:
-						print("* No new hosts found. Still, regenerating file as requested...")
-						to_write = list(old_hosts)
-					else:
-						print("* No new domains found, not updating file.")
-
-			# because TARGET_FILE doesn't exist or ONLY_ADD_NEW isn't set, fail to default behaviour
-			else:
-				to_write = list(tmp)
-
-			# finally, total number of hosts to write.
-			total_hosts = len(to_write)
+	# source of every store in runs, so we know where every domain came from
+	run_sources = []
 
-			# count 'em
-			cnt = 1.0
+	parse_stage = begin_stage("parse")
+	if PROFILE_PARSE_FILE:
+		parse_profiler = cProfile.Profile()
+		parse_profiler.enable()
 
-			if total_hosts > 0:
-				# if ONLY_ADD_NEW flag is set, remove old file before writing, and do it silently.
-				if ONLY_ADD_NEW and os.path.exists(TARGET_FILE):
-					os.remove(TARGET_FILE)
+	# parsed cache keys used in this run
+	parsed_keys = set()
 
-				with open(TARGET_FILE, "w") as target:
-					# generates banner at the top of file. Contains info about hosts and creation date.
-					banner = generate_banner()
-					target.writelines(banner)
+	# more than one worker? let process pool do it.
+	if PARSE_WORKERS > 1:
+		parsed_keys = parse_sources_parallel(content, runs, stats, run_sources)
+		d = url_count
 
-					# now write line by line. Can't be converted to oneliner :(
-					for h in to_write:
-						nl = "%s\n" % h
-						target.writelines(nl)
-
-						# calulate percentage
-						s_perc = cnt/total_hosts
+	# Now, let's loop!
+	while d < url_count:
+		try:
+			# content[] actually contains host url and file name.
+			# file name is used to read data from cache.
+			# smart, eh?
+			c_url = content[d]
+			path = "%s/%s" % (CACHE_PATH, c_url[1])
+
+			counts = stats.setdefault(c_url[1].strip(), collections.Counter())
+			stage = begin_stage(c_url[1].strip(), "sources")
+			parsed_keys.add(parse_source(path, c_url[1].strip(), runs, counts, c_url.format))
+			end_stage(stage, items_in=counts["lines"], items_out=counts["accepted"])
+
+			# remove tmp file
+			if not USE_CACHE:
+				logger.debug("removing cached file...")
+				os.remove(path)
+
+		except Exception as err:
+			print("!! Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
+			logger.error(" Failed reading data from %s: %s" % (str(c_url[1]), repr(err)))
+
+		# parse_source() adds domains parsed before failure too
+		run_sources.extend([c_url[1].strip()] * (len(runs) - len(run_sources)))
+		d+=1
+
+	# merge all sources into one store, dropping duplicates
+	hosts = DomainStore.merge(runs, run_sources)
+	runs = None
+	logger.info("%d unique domains, packed in %d kB", len(hosts), hosts.size() // 1024)
+
+	# results of sources that changed, or aren't in host list base anymore, aren't needed
+	if use_parsed_cache():
+		prune_parsed_cache(parsed_keys)
+
+	if PROFILE_PARSE_FILE:
+		parse_profiler.disable()
+		parse_profiler.dump_stats(PROFILE_PARSE_FILE)
+		print("* Parse stage profile written to %s" % PROFILE_PARSE_FILE)
+	end_stage(parse_stage, items_in=sum(c["lines"] for c in stats.values()), items_out=len(hosts))
+
+	# parallel parsing can't time sources one by one, but we can still count them
+	if PARSE_WORKERS > 1 and profile_report is not None:
+		for (description, counts) in stats.items():
+			profile_report["sources"].append({"name": description, "in": counts["lines"], "out": counts["accepted"]})
+
+	return hosts
 
-						# inform
-						update_progress("Writing hosts %d of %d" % (cnt, total_hosts), s_perc)
-						# ++
-						cnt+=1
+'''
+Daemon mode. With --daemon, script keeps running instead of being started from cron: parsed sources stay
+in memory, and every source is checked on its own interval (SOURCE_INTERVALS, then ttl from host list base, DAEMON_INTERVAL for the rest).
+Checks are conditional requests, so unchanged sources cost almost nothing. Outputs are rebuilt only when
+content of some source really changed, and only changed sources are parsed again.
+Host list base is checked every DATABASE_AGE days, sources added there are parsed, removed ones dropped.
+Status is served as JSON on http://127.0.0.1:STATUS_PORT/status, and /health answers 200 once outputs are built.
+'''
+# daemon status, shared with status server. guarded by daemon_lock.
+daemon_state = {"started": None, "builds": 0, "last_build": None, "last_error": None, "hosts": 0, "sources": {}}
+daemon_lock = threading.Lock()
+
+# returns check interval of host source in seconds: from SOURCE_INTERVALS, ttl from host list base, or DAEMON_INTERVAL
+def source_interval(source):
+	if source.description in SOURCE_INTERVALS:
+		return SOURCE_INTERVALS[source.description] * 3600
+	return (DAEMON_INTERVAL if source.ttl is None else source.ttl) * 3600
+
+# serves daemon status on localhost, in a background thread. returns the server.
+def start_status_server(port):
+	import http.server
+
+	class StatusHandler(http.server.BaseHTTPRequestHandler):
+		def do_GET(self):
+			with daemon_lock:
+				if self.path in ("/", "/status"):
+					(code, body) = (200, daemon_state)
+				elif self.path == "/health":
+					ok = daemon_state["last_build"] is not None
+					(code, body) = (200 if ok else 503, {"ok": ok, "last_build": daemon_state["last_build"]})
+				else:
+					(code, body) = (404, {"error": "not found"})
+				data = json.dumps(body, indent=2).encode("UTF-8")
+
+			self.send_response(code)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def log_message(self, format, *args):
+			logger.debug("status: " + format, *args)
+
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StatusHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	print("* Status served on http://127.0.0.1:%d/status" % port)
+	return server
+
+# updates status of a host source
+def set_source_state(description, **values):
+	with daemon_lock:
+		daemon_state["sources"].setdefault(description, {}).update(values)
+
+# (re)reads host list base, downloading it first if needed. returns content, or None if it failed.
+def load_host_database():
+	if HOSTS_ONLINE and not download_database():
+		return None
+	(state, content) = parse_host_database()
+	return content if state else None
+
+# runs in daemon mode, until interrupted
+def run_daemon():
+	print("* Starting daemon mode")
+	logger.info("Starting daemon mode")
+	with daemon_lock:
+		daemon_state["started"] = time.ctime()
+
+	server = None
+	if STATUS_PORT:
+		server = start_status_server(STATUS_PORT)
+
+	if not os.path.isdir(CACHE_PATH):
+		os.mkdir(CACHE_PATH)
+
+	# parsed sources, parsed cache keys and time of next check (time.monotonic()), by description
+	stores = {}
+	keys = {}
+	due = {}
+	content = []
+	database_due = 0
 
-					print("* Written %d hosts to %s" % (cnt, TARGET_FILE))
+	try:
+		while True:
+			now = time.monotonic()
+			rebuild = False
+
+			if now >= database_due:
+				database_due = now + DATABASE_AGE*86400
+				loaded = load_host_database()
+				if loaded is None:
+					logger.error("Failed reading host list base, keeping the old one")
+				else:
+					content = loaded
+					descriptions = set(c_url[1] for c_url in content)
+					# sources no longer in host list base. every checked source has next check time, parsed or not,
+					# and it has to go too, or sleep would always wake up for it.
+					for description in [d for d in due if d not in descriptions]:
+						logger.info("%s was removed from host list base", description)
+						del due[description]
+						keys.pop(description, None)
+						with daemon_lock:
+							daemon_state["sources"].pop(description, None)
+						if description in stores:
+							del stores[description]
+							rebuild = True
+
+			# sources checked for the first time use cached copy if it's fresh enough, after that they're always revalidated
+			checks = [c_url for c_url in content if due.get(c_url[1], 0) <= now]
+			if len(checks) > 0:
+				failed = {}
+				(_, changed) = download_sources([c_url for c_url in checks if c_url[1] in stores], 0, failed)
+				download_sources([c_url for c_url in checks if c_url[1] not in stores], None, failed)
+				close_connections()
+
+				for c_url in checks:
+					description = c_url[1]
+					due[description] = now + source_interval(c_url)
+					set_source_state(description, url=c_url[0], last_check=time.ctime(), error=failed.get(description),
+						interval_hours=source_interval(c_url) / 3600)
+
+					# parsed sources are parsed again only if they changed. new ones are parsed from cache even if download failed.
+					path = "%s/%s" % (CACHE_PATH, description)
+					if description in stores and (description in failed or description not in changed):
+						continue
+					if description in failed and not os.path.isfile(path):
+						continue
 
-					target.close()
+					try:
+						runs = []
+						counts = collections.Counter()
+						keys[description] = parse_source(path, description, runs, counts, c_url.format)
+						stores[description] = runs[0]
+						set_source_state(description, last_change=time.ctime(), domains=len(runs[0]), stats=dict(counts))
+						rebuild = True
+					except Exception as err:
+						print("!! Failed reading data from %s: %s" % (description, repr(err)))
+						logger.error(" Failed reading data from %s: %s" % (description, repr(err)))
+						set_source_state(description, error=repr(err))
+
+				if use_parsed_cache():
+					prune_parsed_cache(set(keys.values()))
+
+			if rebuild and len(stores) > 0:
+				print("* Rebuilding outputs (%s)" % time.ctime())
+				hosts = DomainStore.merge(list(stores.values()), list(stores.keys()))
+				ok = write_hosts(hosts, content)
+				with daemon_lock:
+					daemon_state["hosts"] = len(hosts)
+					if ok:
+						daemon_state["builds"] += 1
+						daemon_state["last_build"] = time.ctime()
+					else:
+						daemon_state["last_error"] = time.ctime()
+				hosts = None
 
-					# file written an saved, now it's time to push it to git
-					if AUTO_PUSH:
-						push_to_git()
+			# sleep until something is due
+			wake = min(list(due.values()) + [database_due])
+			time.sleep(max(1, wake - time.monotonic()))
 
-			else:
-				print("* No changes. You're up to date!")
+	except KeyboardInterrupt:
+		print("* Stopping daemon")
+		logger.info("Daemon stopped")
 
-		except Exception as e:
-			print("!! Failed to write hosts file: %s" % repr(e))
-			logger.error("Failed to write hosts file: %s" % repr(e))
+	finally:
+		if server is not None:
+			server.shutdown()
 
 # define globals
 content = []
@@ -750,13 +2961,25 @@ old_hosts = []
 # some runtime configuration
 no_push = False
 regenerate = False
+quiet = False
 
-if __name__ == '__main__':
-	print("For command line arguments, start with -h or --help\n")
+# command line. arguments are turned into build() config. returns exit code.
+def cli(argv=None):
 	# parse args
-	logger.info("parsing cmd line arguments.")
-	args = parser.parse_args()
+	parser = make_parser()
+	args = parser.parse_args(argv)
+
+	# queries only read index, and their output is often piped further, so nothing else is printed
+	if args.command == "query":
+		return run_query(args.domains, args.parents, args.index)
 
+	print("For command line arguments, start with -h or --help\n")
+	config = {}
+
+	if args.log_level is not None:
+		config["LOG_LEVEL"] = args.log_level
+
+	setup_logging()
 	logger.info("[args] clear cache: %s, dowload_hosts: %s, remove_target: %s, no_push: %s, no_commit: %s, force_regenerate: %s", args.clear_cache, args.download_hosts, args.remove, args.no_push, args.no_commit, args.force_generate)
 	# now, do stuff user wants
 	if args.clear_cache and not args.download_hosts:
@@ -777,18 +3000,73 @@ if __name__ == '__main__':
 			shutil.rmtree(CACHE_PATH)
 
 	if args.no_push and AUTO_PUSH:
-		no_push = args.no_push
+		config["no_push"] = args.no_push
 		print("* Creating git commit but not pushing changes.")
 
 	if args.no_commit and AUTO_PUSH:
-		AUTO_PUSH = False
+		config["AUTO_PUSH"] = False
 		print("* Disabled git repo update")
 
+	if args.workers is not None:
+		config["DOWNLOAD_WORKERS"] = args.workers
+		print("* Downloading with %d workers" % args.workers)
+
+	if args.jobs is not None:
+		config["PARSE_WORKERS"] = args.jobs
+		print("* Parsing with %d processes" % args.jobs)
+
+	if args.quiet:
+		config["quiet"] = args.quiet
+
+	if args.output is not None:
+		config["EXTRA_OUTPUTS"] = list(EXTRA_OUTPUTS)
+		for output in args.output:
+			(fmt, _, path) = output.partition(":")
+			if fmt not in OUTPUT_FORMATS or len(path) == 0:
+				parser.error("--output must be FORMAT:PATH, with FORMAT one of %s" % ", ".join(sorted(OUTPUT_FORMATS)))
+			config["EXTRA_OUTPUTS"].append((fmt, path))
+
+	if args.sink_ip is not None:
+		config["SINK_IP"] = args.sink_ip
+
+	if args.collapse:
+		config["COLLAPSE_SUBDOMAINS"] = True
+
+	if args.stats is not None:
+		config["STATS_FILE"] = args.stats
+
+	if args.provenance is not None:
+		config["PROVENANCE_FILE"] = args.provenance
+
+	if args.profile is not None:
+		start_profiling()
+
+	if args.profile_parse is not None:
+		config["PROFILE_PARSE_FILE"] = args.profile_parse
+
+	if args.status_port is not None:
+		config["STATUS_PORT"] = args.status_port
+
 	if args.force_generate:
 		print("* Regenrating hosts file even if no changes available")
-		regenerate = args.force_generate
+		config["regenerate"] = args.force_generate
 
-	# run main function
-	main()
+	# run main function. report is written even if build bails out.
+	try:
+		if args.daemon:
+			configure(config)
+			run_daemon()
+		else:
+			build(config)
+	except BuildError as err:
+		return err.code
+	finally:
+		if args.profile is not None:
+			write_profile_report(args.profile)
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(cli())
 
 #################### NO MORE LIONS :( ####################
@@ -0,0 +1,153 @@
+#  conftest.py
+#
+#  Shared fixtures for generate_adblock_urls.py tests
+#
+# Licenced under Apache License Version 2.0
+
+import collections
+import http.server
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+# tests import generate_adblock_urls from the repo, not from wherever pytest is run
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+# every test runs in its own directory, so cache, outputs and logs of real runs aren't touched
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	for path in ("sources", "out", "cache"):
+		os.makedirs(path)
+	return tmp_path
+
+Server = collections.namedtuple("Server", ("path", "url", "httpd"))
+
+# serves files from "www" in work directory on a random local port, over keep-alive HTTP/1.1 connections.
+# yields Server: directory, base url and server, whose attributes tell what was going on and change how files are sent:
+# - connections: client address of every accepted connection
+# - requests: (path, headers) of every request
+# - encoded: names of files sent with Content-Encoding: gzip (files are gzipped already)
+# - drip: file name -> seconds between every 100 bytes of it
+# - cut: file name -> how many bytes are sent before connection is dropped, only once
+# Range requests (bytes=N-) are answered with the rest of file, unless If-Range isn't its Last-Modified.
+@pytest.fixture
+def server(workdir):
+	data_path = os.path.join(str(workdir), "www")
+	os.makedirs(data_path)
+
+	class Handler(http.server.SimpleHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, directory=data_path, **kwargs)
+
+		def setup(self):
+			super().setup()
+			self.server.connections.append(self.client_address)
+
+		def do_GET(self):
+			self.server.requests.append((self.path, dict(self.headers)))
+			path = os.path.join(data_path, self.path.lstrip("/"))
+			ranged = self.headers.get("Range", "")
+			if not ranged.startswith("bytes=") or not os.path.isfile(path):
+				return super().do_GET()
+
+			last_modified = self.date_time_string(os.stat(path).st_mtime)
+			if self.headers.get("If-Range", last_modified) != last_modified:
+				return super().do_GET()
+
+			with open(path, "rb") as f:
+				data = f.read()
+			start = int(ranged[len("bytes="):].rstrip("-"))
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+			self.send_header("Content-Length", str(len(data) - start))
+			self.send_header("Last-Modified", last_modified)
+			self.end_headers()
+			self.copyfile(io.BytesIO(data[start:]), self.wfile)
+
+		def end_headers(self):
+			if self.path.lstrip("/") in self.server.encoded:
+				self.send_header("Content-Encoding", "gzip")
+			super().end_headers()
+
+		def copyfile(self, source, outputfile):
+			cut = self.server.cut.pop(self.path.lstrip("/"), None)
+			if cut is not None:
+				outputfile.write(source.read(cut))
+				outputfile.flush()
+				self.connection.shutdown(socket.SHUT_WR)
+				self.close_connection = True
+				return
+
+			delay = self.server.drip.get(self.path.lstrip("/"))
+			if delay is None:
+				return super().copyfile(source, outputfile)
+			try:
+				for block in iter(lambda: source.read(100), b""):
+					outputfile.write(block)
+					outputfile.flush()
+					time.sleep(delay)
+			except OSError:
+				# client gave up
+				pass
+
+		def log_message(self, *args):
+			pass
+
+	httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+	httpd.connections = []
+	httpd.requests = []
+	httpd.cut = {}
+	httpd.encoded = set()
+	httpd.drip = {}
+	threading.Thread(target=httpd.serve_forever, daemon=True).start()
+	try:
+		yield Server(data_path, "http://127.0.0.1:%d" % httpd.server_port, httpd)
+	finally:
+		httpd.shutdown()
+		httpd.server_close()
+
+# writes sources (dict of name: text, or name: (text, settings in host list base)) and host list base
+# listing them to served directory. returns build() config using them.
+@pytest.fixture
+def sources(server):
+	(data_path, base_url) = server[:2]
+	writes = [0]
+
+	# files written again are newer for If-Modified-Since, even in the same second
+	def touch(path):
+		writes[0] += 1
+		t = time.time() + 2*writes[0]
+		os.utime(path, (t, t))
+
+	def write(files, **config):
+		db_path = os.path.join(data_path, "adblock_list_domains.txt")
+		with open(db_path, "w") as db:
+			for (name, text) in files.items():
+				(text, settings) = text if isinstance(text, tuple) else (text, None)
+				path = os.path.join(data_path, name)
+				with open(path, "w") as source:
+					source.write(text)
+				touch(path)
+				db.write("%s/%s, %s%s\n" % (base_url, name, name, ", " + settings if settings else ""))
+		touch(db_path)
+
+		values = {
+			"HOSTS_URL": "%s/adblock_list_domains.txt" % base_url,
+			"CACHE_AGE": 0,
+			"AUTO_PUSH": False,
+			"LOG_PATH": None,
+			"quiet": True,
+		}
+		values.update(config)
+		return values
+
+	return write
@@ -0,0 +1,14 @@
+#  golden.py
+#
+#  Golden inputs and expected outputs of parser tests, in tests/data
+#
+# Licenced under Apache License Version 2.0
+
+import os
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# reads golden file (UTF-8 text, domains can be IDNs) as list of lines, without line endings
+def read_golden(name):
+	with open(os.path.join(DATA_PATH, name), encoding="UTF-8") as f:
+		return f.read().splitlines()
@@ -0,0 +1,152 @@
+#  test_build.py
+#
+#  build() runs against sources served from a local HTTP server
+#
+# Licenced under Apache License Version 2.0
+
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import os
+import tracemalloc
+
+import pytest
+
+import generate_adblock_urls as g
+
+SOURCE = "0.0.0.0 ads.example.com\n0.0.0.0 tracker.example.org\n"
+
+# second build with no source changed upstream doesn't parse again, and output stays as it is.
+# changed configuration is built again, even when sources didn't change.
+@pytest.mark.parametrize("only_add_new", (True, False))
+def test_unchanged_sources_skip_parsing(sources, only_add_new):
+	files = {"list.txt": SOURCE, "other.txt": "0.0.0.0 other.example.net\n"}
+	config = sources(files, ONLY_ADD_NEW=only_add_new, DATABASE_AGE=0, INDEX_FILE=None)
+
+	first = g.build(config)
+	assert first["written"] and first["hosts"] == 3
+	with open(g.TARGET_FILE) as f:
+		written = f.read()
+
+	second = g.build(config)
+	assert second["changed"] == [] and second["hosts"] is None and not second["written"]
+	with open(g.TARGET_FILE) as f:
+		assert f.read() == written
+
+	changes = [
+		{"SINK_IP": "0.0.0.0"},
+		{"COLLAPSE_SUBDOMAINS": True, "EXTRA_OUTPUTS": [("dnsmasq", "out/dnsmasq.conf")]},
+		{"WHITELISTED_DOMAINS": ["ads.example.com"]},
+		{"INDEX_FILE": "out/hostlist.idx"},
+	]
+	for change in changes:
+		config.update(change)
+		result = g.build(config)
+		assert result["hosts"] is not None and result["written"], change
+		assert g.build(config)["hosts"] is None, change
+	with open(g.TARGET_FILE) as f:
+		assert "0.0.0.0 tracker.example.org" in f.read()
+
+	# source disabled in host list base
+	files["other.txt"] = (files["other.txt"], "enabled=no")
+	config = sources(files, **{name: config[name] for name in config if name.isupper()})
+	result = g.build(config)
+	assert result["hosts"] == 1
+	assert g.build(config)["hosts"] is None
+
+# domains are lowercased when they're parsed, so the same domain in different case is one host, and
+# lookups in index don't depend on case either
+def test_domains_are_normalized(sources, capsys):
+	config = sources({"list.txt": "0.0.0.0 EXAMPLE.com\n0.0.0.0 example.com\n||Ads.Example.ORG^\n"})
+	assert g.build(config)["hosts"] == 2
+	with open(g.TARGET_FILE) as f:
+		written = f.read()
+	assert "127.0.0.1 example.com\n" in written and "ads.example.org" in written and "EXAMPLE" not in written
+
+	capsys.readouterr()
+	assert g.run_query(["Ads.EXAMPLE.org", "example.COM."]) == 0
+	assert capsys.readouterr().out.count("\tblocked\t") == 2
+
+# with ONLY_ADD_NEW, output added to configuration is written even when no list has a new domain
+def test_missing_outputs_are_written(sources):
+	config = sources({"list.txt": SOURCE}, ONLY_ADD_NEW=True, INDEX_FILE=None)
+	assert g.build(config)["written"]
+
+	config = sources({"list.txt": "0.0.0.0 ads.example.com\n"}, ONLY_ADD_NEW=True,
+		EXTRA_OUTPUTS=[("dnsmasq", "out/dnsmasq.conf")], INDEX_FILE="out/index.json")
+	assert g.build(config)["written"]
+	assert os.path.isfile("out/dnsmasq.conf") and os.path.isfile("out/index.json")
+	with open("out/dnsmasq.conf") as f:
+		assert "tracker.example.org" in f.read()
+
+# whitelisted domain under a blocked one gets an exception in outputs blocking subdomains too
+def test_whitelisted_subdomain_isnt_blocked(sources):
+	outputs = [("dnsmasq", "out/dnsmasq.conf"), ("unbound", "out/unbound.conf"), ("rpz", "out/rpz.zone")]
+	config = sources({"list.txt": "0.0.0.0 example.com\n0.0.0.0 ads.example.com\n0.0.0.0 good.example.com\n"},
+		WHITELISTED_DOMAINS=["good.example.com"], EXTRA_OUTPUTS=outputs, COLLAPSE_SUBDOMAINS=True, INDEX_FILE=None)
+	assert g.build(config)["hosts"] == 2
+
+	expected = {
+		"dnsmasq": ["server=/good.example.com/#", "address=/ads.example.com/", "address=/example.com/"],
+		"unbound": ['local-zone: "good.example.com" transparent', 'local-zone: "ads.example.com" always_nxdomain',
+			'local-zone: "example.com" always_nxdomain'],
+		"rpz": ["good.example.com CNAME rpz-passthru.", "*.good.example.com CNAME rpz-passthru.", "ads.example.com CNAME .",
+			"*.ads.example.com CNAME .", "example.com CNAME .", "*.example.com CNAME ."],
+	}
+	for (fmt, path) in outputs:
+		with open(path) as f:
+			lines = [line.rstrip("\n") for line in f if "example.com" in line and not line.startswith(("#", ";"))]
+		assert lines == expected[fmt], fmt
+	with open(g.TARGET_FILE) as f:
+		assert "good.example.com" not in f.read()
+
+# values set by build() reach parsing workers, even when they aren't forked
+def test_config_reaches_spawned_workers(sources, monkeypatch):
+	context = multiprocessing.get_context("spawn")
+	monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", functools.partial(concurrent.futures.ProcessPoolExecutor, mp_context=context))
+
+	config = sources({"list.txt": SOURCE + "0.0.0.0 secret.example.com\n"},
+		WHITELISTED_DOMAINS=["secret.example.com"], PARSE_WORKERS=2, INDEX_FILE=None)
+	result = g.build(config)
+
+	assert result["hosts"] == 2
+	assert result["stats"]["list.txt"]["whitelisted"] == 1
+	with open(g.TARGET_FILE) as f:
+		assert "secret.example.com" not in f.read()
+
+# build() leaves logging of application using it alone, and takes only configuration values
+def test_build_leaves_logging_alone(sources, capfd):
+	root = logging.getLogger()
+	(handlers, level) = (list(root.handlers), root.level)
+
+	config = sources({"list.txt": SOURCE}, LOG_PATH="logs", INDEX_FILE=None)
+	assert g.build(config)["written"]
+
+	assert root.handlers == handlers and root.level == level
+	assert not os.path.exists("logs")
+	assert "ERROR" not in capfd.readouterr().err
+
+	for name in ("PARSER_VERSION", "OUTPUT_FORMATS", "logger"):
+		with pytest.raises(ValueError):
+			g.build({name: None})
+
+# memory of every stage is its own: parse stage keeps its traced peak even though every source resets it,
+# and RSS peak of process is reported as cumulative, with growth of it per stage
+def test_profile_memory(sources, monkeypatch):
+	# b.txt takes more memory while it's parsed than it keeps, a.txt is parsed after it
+	config = sources({"b.txt": "".join("0.0.0.0 ads%d.example.com\n" % (n % 100) for n in range(40000)), "a.txt": SOURCE}, INDEX_FILE=None)
+	monkeypatch.setattr(g, "profile_report", None)
+	g.start_profiling()
+	tracemalloc.start()
+	try:
+		g.build(config)
+	finally:
+		tracemalloc.stop()
+
+	stages = dict((stage["name"], stage) for stage in g.profile_report["stages"])
+	sources = dict((stage["name"], stage) for stage in g.profile_report["sources"])
+	assert stages["parse"]["tracemalloc_peak_kb"] >= max(stage["tracemalloc_peak_kb"] for stage in sources.values())
+	assert sources["b.txt"]["tracemalloc_peak_kb"] > sources["a.txt"]["tracemalloc_peak_kb"]
+	for stage in list(stages.values()) + list(sources.values()):
+		assert 0 <= stage["max_rss_growth_kb"] <= stage["max_rss_kb"]
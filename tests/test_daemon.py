@@ -0,0 +1,60 @@
+#  test_daemon.py
+#
+#  run_daemon() against sources served from a local HTTP server, on a fake clock
+#
+# Licenced under Apache License Version 2.0
+
+import os
+import shutil
+
+import generate_adblock_urls as g
+
+# clock run_daemon() sees. sleeping only moves it forward, and daemon is stopped after given number of sleeps.
+class FakeClock:
+	def __init__(self, sleeps, on_sleep=None):
+		self.now = 1000.0
+		self.sleeps = []
+		self.left = sleeps
+		self.on_sleep = on_sleep
+
+	def monotonic(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.sleeps.append(seconds)
+		self.now += seconds
+		if self.on_sleep is not None:
+			self.on_sleep(self)
+		self.left -= 1
+		if self.left == 0:
+			raise KeyboardInterrupt()
+
+# source removed from host list base isn't waited for anymore
+def test_removed_source_isnt_due(sources, monkeypatch):
+	config = sources({"a.txt": "0.0.0.0 a.example.com\n", "b.txt": "0.0.0.0 b.example.com\n"},
+		HOSTS_ONLINE=False, DATABASE_AGE=1, DAEMON_INTERVAL=1, STATUS_PORT=None, INDEX_FILE=None, ONLY_ADD_NEW=False)
+	shutil.copy(os.path.join("www", "adblock_list_domains.txt"), "sources/adblock_list_domains.txt")
+
+	# host list base loses b.txt after first check, daemon sees it when it reads host list base again, a day later
+	def remove_source(clock):
+		if len(clock.sleeps) == 1:
+			with open("sources/adblock_list_domains.txt") as db:
+				lines = [line for line in db if "b.txt" not in line]
+			with open("sources/adblock_list_domains.txt", "w") as db:
+				db.writelines(lines)
+
+	clock = FakeClock(40, remove_source)
+	monkeypatch.setattr(g.time, "monotonic", clock.monotonic)
+	monkeypatch.setattr(g.time, "sleep", clock.sleep)
+
+	old = g.configure(config)
+	try:
+		g.run_daemon()
+	finally:
+		g.configure(old)
+
+	# hourly checks of a.txt. without b.txt, nothing is due sooner than that.
+	assert clock.sleeps == [3600] * 40
+	with open(g.TARGET_FILE) as f:
+		written = f.read()
+	assert "a.example.com" in written and "b.example.com" not in written
@@ -0,0 +1,123 @@
+#  test_download.py
+#
+#  Downloads from a local HTTP server: stream_download() and fetch_source()
+#
+# Licenced under Apache License Version 2.0
+
+import gzip
+import os
+import time
+
+import pytest
+
+import generate_adblock_urls as g
+
+# runs with given configuration, and closes pooled connections after, so tests don't share them
+@pytest.fixture
+def config():
+	saved = []
+
+	def set_config(**values):
+		saved.append(g.configure(values))
+
+	yield set_config
+	for old in reversed(saved):
+		g.configure(old)
+	g.close_connections()
+
+# server sending a little now and then can't hold download longer than DOWNLOAD_TIMEOUT
+def test_download_deadline(server, config):
+	with open(os.path.join(server.path, "slow.txt"), "w") as f:
+		f.write("0.0.0.0 ads.example.com\n" * 100)
+	server.httpd.drip["slow.txt"] = 0.1
+	config(DOWNLOAD_TIMEOUT=0.5)
+
+	start = time.monotonic()
+	with pytest.raises(TimeoutError):
+		g.stream_download("%s/slow.txt" % server.url, "cache/slow.txt")
+	assert time.monotonic() - start < 1.5
+
+	# what came is kept, so download can be resumed
+	assert not os.path.exists("cache/slow.txt")
+	assert 0 < os.path.getsize("cache/slow.txt.part") < 2400
+
+# sources from one server are downloaded over one connection, revalidating them (304 Not Modified) doesn't
+# open another one, and gzipped responses are cached decoded
+def test_connection_reuse(server, config):
+	content = []
+	for i in range(6):
+		name = "list%d.txt" % i
+		text = "0.0.0.0 ads%d.example.com\n" % i
+		if i == 0:
+			with gzip.open(os.path.join(server.path, name), "wt") as f:
+				f.write(text)
+			server.httpd.encoded.add(name)
+		else:
+			with open(os.path.join(server.path, name), "w") as f:
+				f.write(text)
+		content.append(g.Source("%s/%s" % (server.url, name), name, "auto", None, True, 0, None))
+	config(CACHE_AGE=0, DOWNLOAD_WORKERS=1, CACHE_COMPRESSION=False, quiet=True)
+
+	(ok, changed) = g.download_sources(content)
+	assert ok and sorted(changed) == sorted(source.description for source in content)
+	assert len(server.httpd.connections) == 1
+
+	(ok, changed) = g.download_sources(content)
+	assert ok and changed == []
+	assert len(server.httpd.connections) == 1
+
+	with open(os.path.join(g.CACHE_PATH, "list0.txt")) as f:
+		assert f.read() == "0.0.0.0 ads0.example.com\n"
+
+# writes file of given size to served directory, newer than anything written before. returns its content.
+def write_served(server, name, size, seed):
+	data = b"".join(b"0.0.0.0 ads%d.example%d.com\n" % (n, seed) for n in range(size // 20))[:size]
+	path = os.path.join(server.path, name)
+	with open(path, "wb") as f:
+		f.write(data)
+	t = time.time() + 10*seed
+	os.utime(path, (t, t))
+	return data
+
+# interrupted download is resumed where it stopped, with Range and If-Range, and result is the whole file
+def test_resume_interrupted(server, config):
+	data = write_served(server, "big.txt", 200000, 1)
+	server.httpd.cut["big.txt"] = 50000
+
+	with pytest.raises(ConnectionError):
+		g.stream_download("%s/big.txt" % server.url, "cache/big.txt")
+	assert os.path.getsize("cache/big.txt.part") == 50000
+
+	(changed, info) = g.stream_download("%s/big.txt" % server.url, "cache/big.txt")
+	(path, headers) = server.httpd.requests[-1]
+	assert headers["Range"] == "bytes=50000-" and headers["If-Range"] == info["last_modified"]
+	assert changed and not os.path.exists("cache/big.txt.part")
+	with open("cache/big.txt", "rb") as f:
+		assert f.read() == data
+
+# file changed since download was interrupted: If-Range doesn't match, and download starts from zero
+def test_resume_changed_file(server, config):
+	write_served(server, "big.txt", 200000, 1)
+	server.httpd.cut["big.txt"] = 50000
+	with pytest.raises(ConnectionError):
+		g.stream_download("%s/big.txt" % server.url, "cache/big.txt")
+
+	data = write_served(server, "big.txt", 150000, 2)
+	(changed, info) = g.stream_download("%s/big.txt" % server.url, "cache/big.txt")
+	assert server.httpd.requests[-1][1]["Range"] == "bytes=50000-"
+	with open("cache/big.txt", "rb") as f:
+		assert f.read() == data
+
+# download bigger than max size leaves nothing behind, whether it's refused right away or when it's resumed
+def test_max_size(server, config):
+	write_served(server, "big.txt", 200000, 1)
+	with pytest.raises(ValueError):
+		g.stream_download("%s/big.txt" % server.url, "cache/big.txt", max_size=100000)
+	assert os.listdir("cache") == []
+
+	server.httpd.cut["big.txt"] = 50000
+	with pytest.raises(ConnectionError):
+		g.stream_download("%s/big.txt" % server.url, "cache/big.txt")
+	with pytest.raises(ValueError):
+		g.stream_download("%s/big.txt" % server.url, "cache/big.txt", max_size=100000)
+	assert os.listdir("cache") == []
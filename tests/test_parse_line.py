@@ -0,0 +1,47 @@
+#  test_parse_line.py
+#
+#  Equivalence of line classification with parse_line() of the original script.
+#  data/parse_line.txt has lines built around every ignored symbol and extension, in plain, hosts and
+#  ABP lines, and data/parse_line.expected has what original parse_line() returned for each of them:
+#  "ok<TAB>domain" if line was written, "rejected" if it wasn't. Whitelist is the one set below.
+#  Only difference is normalization: domains are lowercased, so uppercase file extensions are rejected too.
+#
+# Licenced under Apache License Version 2.0
+
+import collections
+import os
+
+import pytest
+
+import generate_adblock_urls as g
+from golden import DATA_PATH, read_golden
+
+@pytest.fixture(autouse=True)
+def whitelist():
+	old = g.configure({
+		"WHITELISTED_DOMAINS": ["google.com", "facebook.com"],
+		"WHITELISTED_WILDCARD_DOMAINS": ["*.cloudfront.net", "ads?.tracker.org"],
+		"WHITELIST_FILENAME": None,
+	})
+	yield
+	g.configure(old)
+
+# returns (lines, expected results)
+def golden():
+	lines = list(g.iter_source_lines(os.path.join(DATA_PATH, "parse_line.txt")))
+	expected = [tuple(e.split("\t")) for e in read_golden("parse_line.expected")]
+	assert len(lines) == len(expected)
+	return (lines, expected)
+
+def test_classify_line():
+	(lines, expected) = golden()
+	for (y, e) in zip(lines, expected):
+		(reason, value) = g.classify_line(y)
+		assert (("ok", value) if reason is None else ("rejected",)) == e, y
+
+@pytest.mark.parametrize("fmt", sorted(g.SOURCE_FORMATS))
+def test_parse_lines(fmt):
+	(lines, expected) = golden()
+	stats = collections.Counter()
+	assert list(g.parse_lines(iter(lines), stats, fmt)) == [e[1] for e in expected if e[0] == "ok"]
+	assert stats["lines"] == len(lines)
@@ -0,0 +1,115 @@
+#  test_parser.py
+#
+#  Golden tests of line classification, format parsers and format sniffing.
+#  Every data/<name>.txt has data/<name>.expected, with result of every non-empty line:
+#  "ok<TAB>domain" if line is accepted, rejection reason if it's not.
+#
+# Licenced under Apache License Version 2.0
+
+import collections
+import gzip
+import os
+import shutil
+
+import pytest
+
+import generate_adblock_urls as g
+from golden import DATA_PATH, read_golden
+
+# golden inputs, and format they are in
+GOLDEN = {
+	"hosts": "hosts",
+	"domains": "domains",
+	"abp": "abp",
+}
+
+# golden results don't depend on whitelist in the script or in sources/whitelist.txt
+@pytest.fixture(autouse=True)
+def whitelist():
+	old = g.configure({
+		"WHITELISTED_DOMAINS": ["google.com"],
+		"WHITELISTED_WILDCARD_DOMAINS": ["*.cloudfront.net"],
+		"WHITELIST_FILENAME": None,
+	})
+	yield
+	g.configure(old)
+
+# returns (lines, expected results) of golden input
+def golden(name):
+	path = os.path.join(DATA_PATH, "%s.txt" % name)
+	lines = list(g.iter_source_lines(path))
+	expected = [tuple(e.split("\t")) for e in read_golden("%s.expected" % name)]
+	assert len(lines) == len(expected)
+	return (lines, expected)
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_classify_line(name):
+	(lines, expected) = golden(name)
+	for (y, e) in zip(lines, expected):
+		(reason, value) = g.classify_line(y)
+		assert (("ok", value) if reason is None else (reason,)) == e, y
+
+# every parser gives the same result on every input, format only decides what's tried first
+@pytest.mark.parametrize("fmt", sorted(g.SOURCE_FORMATS))
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_format_parsers(name, fmt):
+	(lines, expected) = golden(name)
+	stats = collections.Counter()
+	domains = list(g.parse_lines(iter(lines), stats, fmt))
+
+	assert domains == [e[1] for e in expected if e[0] == "ok"]
+	reasons = collections.Counter(e[0] for e in expected if e[0] != "ok")
+	assert stats == reasons + collections.Counter(lines=len(lines), accepted=len(domains))
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_sniff_format(name, tmp_path):
+	path = os.path.join(DATA_PATH, "%s.txt" % name)
+	assert g.sniff_format(path) == GOLDEN[name]
+	assert g.source_format(path) == GOLDEN[name]
+
+	# cached sources can be gzipped, see CACHE_COMPRESSION
+	compressed = str(tmp_path / ("%s.txt.gz" % name))
+	with open(path, "rb") as source, gzip.open(compressed, "wb") as target:
+		shutil.copyfileobj(source, target)
+	assert g.sniff_format(compressed) == GOLDEN[name]
+
+# format set in host list base is used as it is, sources with nothing but comments are parsed with general parser
+def test_sniff_fallback(tmp_path):
+	path = str(tmp_path / "comments.txt")
+	with open(path, "w") as f:
+		f.write("# only\n! comments\n[Adblock Plus 2.0]\n\n")
+	assert g.sniff_format(path) == "auto"
+	assert g.source_format(os.path.join(DATA_PATH, "hosts.txt"), "abp") == "abp"
+
+# exception rules unblock their domains and subdomains, in the whole source even when it's parsed in chunks.
+# data/abp_exceptions.expected has domains left after parsing, sorted.
+@pytest.mark.parametrize("workers", (1, 2))
+def test_abp_exceptions(workdir, workers):
+	shutil.copy(os.path.join(DATA_PATH, "abp_exceptions.txt"), os.path.join(g.CACHE_PATH, "abp_exceptions.txt"))
+	content = [g.Source("http://127.0.0.1/abp_exceptions.txt", "abp_exceptions.txt", "abp", None, True, 0, None)]
+	old = g.configure({"PARSE_WORKERS": workers, "PARSE_CHUNK_SIZE": 64, "USE_CACHE": True, "quiet": True})
+	try:
+		stats = {}
+		hosts = g.parse_sources(content, stats)
+	finally:
+		g.configure(old)
+
+	assert list(hosts) == read_golden("abp_exceptions.expected")
+	assert stats["abp_exceptions.txt"]["exception"] == 7
+
+def test_read_abp_rule():
+	assert g.read_abp_rule(b"||ads.example.com^") == (None, b"ads.example.com")
+	assert g.read_abp_rule(b"||ads.example.com^$third-party,script") == (None, b"ads.example.com")
+	assert g.read_abp_rule(b"@@||ads.example.com^")[0] == "exception"
+	assert g.read_abp_rule(b"||ads.example.com/banner^")[0] == "partial"
+	assert g.read_abp_rule(b"||ads.example.com^$domain=example.org")[0] == "partial"
+	assert g.read_abp_rule(b"||ads.example.com^$DOMAIN=example.org")[0] == "partial"
+	assert g.read_abp_rule(b"||ads.example.com^$~third-party,domain=~example.org")[0] == "partial"
+
+def test_whitelist():
+	assert g.is_whitelisted("google.com")
+	assert not g.is_whitelisted("www.google.com")
+	assert g.is_whitelisted("d1.cloudfront.net")
+	assert g.is_whitelisted("a.b.cloudfront.net")
+	assert not g.is_whitelisted("cloudfront.net")
+	assert not g.is_whitelisted("notcloudfront.net")